@@ -1,23 +1,39 @@
 import os
+import re
+import json
+import fcntl
+import sqlite3
+import time
 import uuid
-from flask import Flask, request, jsonify, send_from_directory
+import hashlib
+import math
+import struct
+import threading
+import queue
+import subprocess
+import mimetypes
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify
 from flask_restful import Resource, Api
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header, http_date
+from werkzeug.security import safe_join
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 from pydub import AudioSegment
+from pydub.utils import get_prober_name
 # Updated MoviePy imports for version 2.2.1
-from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.video.VideoClip import ColorClip, TextClip, ImageClip # Common location for these base clips
+from moviepy.video.VideoClip import VideoClip, ImageClip # Common location for these base clips
 from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
 import logging
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageFont
 import shutil # For cleaning up temp directories
 import matplotlib
-matplotlib.use('Agg') # Use 'Agg' backend for non-interactive plotting (important for server environments)
-import matplotlib.pyplot as plt
-from matplotlib.patches import Circle
+from matplotlib import font_manager
+from moviepy.config import FFMPEG_BINARY
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,17 +45,220 @@ CORS(app) # Enable CORS for all routes
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 GENERATED_FILES_FOLDER = 'generated_files'
-TEMP_FRAMES_FOLDER = 'temp_frames' # New folder for waveform frames
+UPLOAD_SESSIONS_FOLDER = 'upload_sessions' # Preallocated files and manifests of resumable uploads
+ASSET_LIBRARY_FOLDER = 'asset_library' # Finalized uploads, stored by content hash
+BACKGROUND_CACHE_FOLDER = 'background_cache' # Backgrounds already decoded and fitted to a video size
+JOB_STORE_FOLDER = 'job_store' # SQLite job store and the lock files of the worker processes using it
 ALLOWED_AUDIO_EXTENSIONS = {'wav', 'mp3', 'webm', 'ogg', 'aac'}
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_CAPTION_EXTENSIONS = {'srt', 'vtt'}
+
+# File fields accepted by the generate endpoint: field name -> (allowed extensions, media kind, label)
+UPLOAD_FILE_FIELDS = {
+    'uploadedAudio': (ALLOWED_AUDIO_EXTENSIONS, 'audio', 'Uploaded audio file'),
+    'recordedAudio': (ALLOWED_AUDIO_EXTENSIONS, 'audio', 'Recorded audio file'),
+    'backgroundImage': (ALLOWED_IMAGE_EXTENSIONS, 'image', 'Background image file'),
+    'captionsFile': (ALLOWED_CAPTION_EXTENSIONS, 'captions', 'Captions file'),
+}
+
+# File fields accepted by the asset library endpoint
+ASSET_FILE_FIELDS = {
+    'audio': (ALLOWED_AUDIO_EXTENSIONS, 'audio', 'Audio asset'),
+    'image': (ALLOWED_IMAGE_EXTENSIONS, 'image', 'Image asset'),
+}
+
+# Upload limits (streamed uploads are rejected as soon as a limit is crossed)
+MAX_UPLOAD_FILE_BYTES = 512 * 1024 * 1024 # Per-file cap
+MAX_UPLOAD_REQUEST_BYTES = 1024 * 1024 * 1024 # Cap for a whole multipart request
+MAX_FORM_FIELD_BYTES = 64 * 1024 # Cap for a single non-file form field kept in memory
+UPLOAD_CHUNK_SIZE = 256 * 1024 # Bytes read from the request body per iteration
+UPLOAD_SNIFF_BYTES = 16 # Leading bytes buffered to check a file's magic signature before touching disk
+
+# Download delivery. When a front proxy serves generated_files itself, set one of these to offload the bytes.
+DOWNLOAD_X_SENDFILE = False # Send an X-Sendfile header (Apache mod_xsendfile, lighttpd) instead of the body
+DOWNLOAD_X_ACCEL_REDIRECT_PREFIX = None # nginx internal location, e.g. '/protected/generated_files/'
+DOWNLOAD_READ_CHUNK_BYTES = 1024 * 1024 # Chunk size when a byte range has to be streamed from Python
+
+# Video output. 'faststart' MP4s play before they are fully downloaded; 'fragmented' MP4 and 'hls'
+# are written progressively and can be watched while the render is still encoding.
+VIDEO_OUTPUT_MODES = ('faststart', 'fragmented', 'hls')
+PROGRESSIVE_OUTPUT_MODES = ('fragmented', 'hls')
+VIDEO_SEGMENT_SECONDS = 4 # HLS segment / MP4 fragment length (a keyframe is forced at each boundary)
+
+# Disk janitor. Generated videos are evicted by age and, above the byte budget, least recently downloaded
+# first; leftovers of dead workers in the temp folders are swept at startup and then periodically.
+JANITOR_ENABLED = True
+JANITOR_INTERVAL_SECONDS = 10 * 60
+GENERATED_FILES_MAX_BYTES = 20 * 1024 * 1024 * 1024
+GENERATED_FILES_MAX_AGE_SECONDS = 7 * 24 * 3600
+# Temp entries younger than this are never swept, since other worker processes may still own them.
+# Keep it longer than the longest expected render.
+TEMP_DATA_GRACE_SECONDS = 6 * 3600
+UPLOAD_SESSION_MAX_AGE_SECONDS = 2 * 24 * 3600 # Abandoned resumable uploads
+
+# Scratch space for per-job intermediates (streamed uploads, merged audio, waveform frames). A job whose
+# estimated footprint fits the RAM tier (tmpfs) runs there; bigger jobs, or a nearly full tmpfs, use disk.
+SCRATCH_RAM_ROOT = '/dev/shm/podcast_creator' # None disables the RAM tier
+SCRATCH_DISK_ROOT = 'scratch'
+SCRATCH_RAM_JOB_MAX_BYTES = 1024 * 1024 * 1024 # Per-job budget: jobs estimated above this always go to disk
+SCRATCH_RAM_RESERVE_BYTES = 512 * 1024 * 1024 # tmpfs is RAM, so always leave this much of it free
+SCRATCH_AUDIO_BYTES_PER_SECOND = 24 * 1024 # The AAC soundtrack (AUDIO_TRACK_BITRATE)
+
+# Decoded audio assets are cached once in this canonical layout and reused by every job
+ASSET_PCM_SAMPLE_RATE = 44100
+ASSET_PCM_CHANNELS = 2
+ASSET_PCM_CONVERT_BLOCK_FRAMES = 1024 * 1024 # Cached float32 frames converted to 16-bit at a time
+FFMPEG_ERROR_TAIL_LINES = 20 # Last lines of a failed decode's stderr kept for its error message
+DECODE_INITIAL_BUFFER_SECONDS = 60 # Decode buffer for inputs of unknown length; it grows as the decode needs
+
+# Peak data for client-side waveforms, served in audiowaveform's binary .dat format (version 1)
+PEAKS_BASE_SAMPLES_PER_PIXEL = 256 # Finest zoom level (audiowaveform's default)
+PEAKS_LEVELS = 9 # Every level halves the previous one's resolution: 256 ... 65536 samples per pixel
+PEAKS_BLOCK_FRAMES = PEAKS_BASE_SAMPLES_PER_PIXEL * 4096 # PCM frames reduced per vectorized step
+PEAKS_BITS = (8, 16)
+
+# Rendered video geometry and encoder parallelism
+VIDEO_WIDTH, VIDEO_HEIGHT = 1280, 720
+VIDEO_FPS = 24 # Standard video FPS
+RENDER_ENCODE_THREADS = 4 # libx264 threads per render
+RENDER_IO_WORKERS = 2 * (os.cpu_count() or 1) # Shared pool for the ffmpeg subprocesses of renders (decodes, audio track)
+AUDIO_TRACK_BITRATE = '192k' # AAC soundtrack, encoded once and copied into the video
+
+# Admission control. Each render's cost is estimated from its probed duration x resolution x fps; renders
+# only start while the global CPU and RAM budgets hold them, others wait in a bounded queue or get a 429.
+ADMISSION_CPU_THREADS = max(os.cpu_count() or 1, RENDER_ENCODE_THREADS) # Encoder threads running at once
+ADMISSION_RAM_BYTES = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 # Estimated render memory at once
+ADMISSION_MAX_QUEUED = 16 # Renders waiting for budget before new ones are rejected
+ADMISSION_MAX_QUEUE_WAIT_SECONDS = 120 # A synchronous request gives up (429) after waiting this long
+RENDER_BASE_RAM_BYTES = 300 * 1024 * 1024 # MoviePy, ffmpeg pipes and encoder buffers of one render
+# Peak audio memory, in copies of the 16-bit mix format. The mix: the mix itself, its sample array and the
+# float32 mono downmix the analysis makes of it. Each input track: its 16-bit decode and one conversion or
+# processing copy of it, or the float32 decode that fills an asset's PCM cache, which is as large.
+RENDER_AUDIO_RAM_BYTES_PER_SECOND = 3 * ASSET_PCM_SAMPLE_RATE * ASSET_PCM_CHANNELS * 2
+DECODED_TRACK_RAM_BYTES_PER_SECOND = 2 * ASSET_PCM_SAMPLE_RATE * ASSET_PCM_CHANNELS * 2
+RENDER_PIXEL_FRAMES_PER_SECOND = VIDEO_WIDTH * VIDEO_HEIGHT * VIDEO_FPS // 2 # Render throughput, about half real time
+PROBE_FALLBACK_BYTES_PER_SECOND = 4 * 1024 # Duration guess for files without one in their header (e.g. MediaRecorder WebM)
+PROBE_TIMEOUT_SECONDS = 10
+MAX_AUDIO_DURATION_SECONDS = 4 * 3600 # Inputs whose header says they are longer are rejected before any decode
+MAX_AUDIO_CHANNELS = 8
+SUPPORTED_AUDIO_CODECS = {'pcm_u8', 'pcm_s16le', 'pcm_s16be', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le', 'pcm_f64le', 'pcm_alaw', 'pcm_mulaw',
+                          'mp3', 'aac', 'opus', 'vorbis', 'flac', 'alac'}
+
+# Render scheduling among queued renders. 'fifo' is arrival order; 'sjf' starts the shortest estimated render
+# first, aged so long renders still get served; 'fair' applies sjf to the API client with the least work running.
+# Preview renders always go first and may pause running full renders at their next checkpoint.
+SCHEDULER_POLICIES = ('fifo', 'sjf', 'fair')
+SCHEDULER_POLICY = 'fair'
+SCHEDULER_AGING_RATE = 2.0 # Estimated render seconds forgiven per second spent waiting
+SCHEDULER_STATS_SAMPLES = 1000 # Latest finished renders kept per policy for the percentiles
+CLIENT_ID_HEADER = 'X-Client-Id' # Fair-share key; the remote address is used without it
+RENDER_MODES = ('full', 'preview')
+PREVIEW_MAX_SECONDS = 30 # A preview renders only the beginning of the mix...
+PREVIEW_X264_PRESET = 'ultrafast' # ...with the fastest encoder preset
+
+# Persistent job store. Every render is recorded with its inputs, parameters, stage and result, so jobs
+# interrupted by a restart are started again on boot and finished results stay addressable.
+JOB_STORE_PATH = os.path.join(JOB_STORE_FOLDER, 'jobs.sqlite3')
+JOB_WORKERS_FOLDER = os.path.join(JOB_STORE_FOLDER, 'workers') # One flock'ed file per live worker process
+JOB_RESUME_ON_BOOT = True
+# Upload field -> params prefix of the job inputs that are persisted to the asset library
+JOB_INPUT_FIELDS = {
+    'uploadedAudio': 'uploaded_audio',
+    'recordedAudio': 'recorded_audio',
+    'backgroundImage': 'background_image',
+    'captionsFile': 'captions',
+}
+
+# Idempotent generate requests. A retry carrying the same Idempotency-Key (per client) attaches to the job
+# the first request started instead of rendering again.
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_POLL_SECONDS = 1.0 # Status poll interval of a synchronous retry waiting for the original job
+
+# Resumable upload limits
+DEFAULT_RESUMABLE_CHUNK_BYTES = 8 * 1024 * 1024
+MAX_RESUMABLE_CHUNK_BYTES = 64 * 1024 * 1024
+MAX_RESUMABLE_UPLOAD_BYTES = 4 * 1024 * 1024 * 1024 # Hour-long multichannel WAVs fit comfortably
+
+# Background image cache (entries are fitted RGB arrays keyed by image hash, size and fit mode)
+BACKGROUND_FIT_MODES = ('stretch', 'cover', 'contain', 'crop')
+BACKGROUND_FILL_MODES = ('contain', 'crop') # Fit modes that show the background colour around the image
+BACKGROUND_CACHE_MAX_ENTRIES = 16 # In-memory LRU entries (a 1280x720 background is ~2.7 MB)
+BACKGROUND_CACHE_MAX_DISK_BYTES = 1024 * 1024 * 1024 # On-disk cache size before least recently used entries are pruned
+
+# Text overlay rendering (Pillow FreeType with cached glyphs and finished layers)
+TEXT_OVERLAY_FONT_PATH = None # Path to a TrueType font; None uses the DejaVu Sans font bundled with Matplotlib
+TEXT_OVERLAY_FONT_SIZE = 50
+TEXT_OVERLAY_COLOR = '#ffffff'
+TEXT_OVERLAY_STROKE_COLOR = '#000000'
+TEXT_OVERLAY_STROKE_WIDTH = 1
+TEXT_OVERLAY_MAX_WIDTH_RATIO = 0.9 # Lines wrap at this fraction of the video width
+TEXT_OVERLAY_TOP_RATIO = 0.05 # Distance of the overlay from the top edge, as a fraction of the video height
+TEXT_OVERLAY_LINE_SPACING = 4 # Extra pixels between wrapped lines
+TEXT_ALIGNMENTS = ('left', 'center', 'right')
+TEXT_LAYER_CACHE_MAX_ENTRIES = 64
+
+# Timed captions (SRT/WebVTT) burned into the video or muxed as a soft subtitle stream
+CAPTION_MODES = ('burn', 'soft')
+CAPTION_FONT_SIZE = 36
+CAPTION_COLOR = '#ffffff'
+CAPTION_STROKE_COLOR = '#000000'
+CAPTION_STROKE_WIDTH = 2
+CAPTION_MAX_WIDTH_RATIO = 0.8
+CAPTION_BOTTOM_RATIO = 0.08 # Distance of the caption's bottom edge from the bottom of the frame
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['GENERATED_FILES_FOLDER'] = GENERATED_FILES_FOLDER
-app.config['TEMP_FRAMES_FOLDER'] = TEMP_FRAMES_FOLDER
+app.config['SCRATCH_RAM_ROOT'] = SCRATCH_RAM_ROOT
+app.config['SCRATCH_DISK_ROOT'] = SCRATCH_DISK_ROOT
+app.config['SCRATCH_RAM_JOB_MAX_BYTES'] = SCRATCH_RAM_JOB_MAX_BYTES
+app.config['UPLOAD_SESSIONS_FOLDER'] = UPLOAD_SESSIONS_FOLDER
+app.config['ASSET_LIBRARY_FOLDER'] = ASSET_LIBRARY_FOLDER
+app.config['BACKGROUND_CACHE_FOLDER'] = BACKGROUND_CACHE_FOLDER
+app.config['JOB_STORE_PATH'] = JOB_STORE_PATH
+app.config['JOB_RESUME_ON_BOOT'] = JOB_RESUME_ON_BOOT
+app.config['IDEMPOTENCY_KEY_TTL_SECONDS'] = IDEMPOTENCY_KEY_TTL_SECONDS
+app.config['DOWNLOAD_X_SENDFILE'] = DOWNLOAD_X_SENDFILE
+app.config['DOWNLOAD_X_ACCEL_REDIRECT_PREFIX'] = DOWNLOAD_X_ACCEL_REDIRECT_PREFIX
+app.config['JANITOR_ENABLED'] = JANITOR_ENABLED
+app.config['GENERATED_FILES_MAX_BYTES'] = GENERATED_FILES_MAX_BYTES
+app.config['GENERATED_FILES_MAX_AGE_SECONDS'] = GENERATED_FILES_MAX_AGE_SECONDS
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_REQUEST_BYTES
+app.config['ADMISSION_CPU_THREADS'] = ADMISSION_CPU_THREADS
+app.config['ADMISSION_RAM_BYTES'] = ADMISSION_RAM_BYTES
+app.config['ADMISSION_MAX_QUEUED'] = ADMISSION_MAX_QUEUED
+app.config['SCHEDULER_POLICY'] = SCHEDULER_POLICY
+app.config['MAX_UPLOAD_FILE_BYTES'] = MAX_UPLOAD_FILE_BYTES
+app.config['MAX_AUDIO_DURATION_SECONDS'] = MAX_AUDIO_DURATION_SECONDS
 
 # Define constants for audio processing
 BACKGROUND_AUDIO_VOLUME_DB = -20 # A negative value means quieter. -20 dB should make it significantly lower.
 WAVEFORM_AMPLITUDE_MULTIPLIER = 1.5 # Increase this value to make the waveform peaks higher.
+WAVEFORM_BAND_HEIGHT_RATIO = 0.5 # Fraction of the video height occupied by the 'bars' and 'lines' waveform band.
+WAVEFORM_CIRCLE_LINE_WIDTH = 3 # Stroke width of the 'circles' style, also used as padding around its bounding box.
+WAVEFORM_ANALYSIS_RATE = 11025 # Visual features are computed at about this rate, whatever the audio's rate
+WAVEFORM_DECIMATION_HALF_TAPS = 16 # Anti-alias FIR length on each side, in analysis-rate samples
+WAVEFORM_DECIMATION_CUTOFF = 0.9 # Of the analysis Nyquist frequency
+SMOOTH_LINES_CONTROL_POINTS = 48 # Peaks per frame the 'smooth-lines' spline passes through
+WAVEFORM_LINE_WIDTH = 2 # Stroke width in pixels of the line styles
+WAVEFORM_BAR_COUNT = 100 # Bars of the 'bars' styles, bands of 'frequency-bars'
+WAVEFORM_BAR_FILL_RATIO = 0.8 # Fraction of a bar's slot it fills; the rest is the gap
+WAVEFORM_SPECTRUM_MIN_HZ = 50
+WAVEFORM_SPECTRUM_MAX_HZ = 5000 # Kept below the Nyquist frequency of the analysis rate
+WAVEFORM_SPECTRUM_DB_RANGE = 60 # Band levels from -60 dBFS (empty) to 0 dBFS (full)
+WAVEFORM_SPECTRUM_FFT_SIZE = 512 # ~46 ms at the analysis rate
+WAVEFORM_ANALYSIS_HOP = 256 # Samples between track feature values, ~23 ms at the analysis rate; independent of the fps
+WAVEFORM_ATTACK_SECONDS = 0.01 # Levels rise this fast...
+WAVEFORM_RELEASE_SECONDS = 0.15 # ...and fall back this slowly
+WAVEFORM_BARS_HISTORY_SECONDS = 4.0 # Time the 'bars-history' style spans across its width
+SPECTROGRAM_FFT_SIZE = 512 # ~46 ms at the analysis rate
+SPECTROGRAM_COLUMNS_PER_FRAME = 2 # Scroll speed; the 1280 px band then shows the last ~27 s at 24 fps
+SPECTROGRAM_DB_RANGE = 80
+SPECTROGRAM_COLORMAP = 'magma'
+WAVEFORM_FFT_BLOCK = 2048 # Spectrum windows transformed at once
+WAVEFORM_RENDER_BATCH_FRAMES = 24 # Frames rasterized together; bounds the per-batch buffers
+WAVEFORM_RENDER_QUEUE_BATCHES = 2 # Batches rendered ahead of the encoder; bounds the memory of the frame pipeline
 
 # Constants for recorded voice processing (equalization and noise removal)
 # These values are examples and can be adjusted based on desired audio characteristics.
@@ -47,16 +266,953 @@ RECORDED_VOICE_HIGH_PASS_FREQ_HZ = 100 # Cut frequencies below this (e.g., to re
 RECORDED_VOICE_LOW_PASS_FREQ_HZ = 8000  # Cut frequencies above this (e.g., to reduce hiss/harshness)
 RECORDED_VOICE_GAIN_DB = 3              # Apply a slight gain to the voice for presence
 
+# Live recording ingest: MediaRecorder chunks are piped into one ffmpeg per recording, which decodes them and
+# applies the voice chain of equalize_and_denoise_recorded_voice() while the user is still recording.
+RECORDING_VOICE_FILTERS = (f"highpass=f={RECORDED_VOICE_HIGH_PASS_FREQ_HZ}:poles=1,"
+                           f"lowpass=f={RECORDED_VOICE_LOW_PASS_FREQ_HZ}:poles=1,volume={RECORDED_VOICE_GAIN_DB}dB")
+MAX_RECORDING_BYTES = MAX_UPLOAD_FILE_BYTES
+MAX_RECORDING_CHUNK_BYTES = 16 * 1024 * 1024
+RECORDING_MAX_PENDING_CHUNKS = 64 # Out-of-order chunks buffered while an earlier one is still in flight
+RECORDING_IDLE_TIMEOUT_SECONDS = 15 * 60 # Recordings without a new chunk for this long are abandoned
+RECORDING_FINISH_TIMEOUT_SECONDS = 120 # Time ffmpeg gets to flush the tail of a recording
+
 # Create necessary directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(GENERATED_FILES_FOLDER, exist_ok=True)
-os.makedirs(TEMP_FRAMES_FOLDER, exist_ok=True)
+os.makedirs(SCRATCH_DISK_ROOT, exist_ok=True)
+os.makedirs(UPLOAD_SESSIONS_FOLDER, exist_ok=True)
+os.makedirs(ASSET_LIBRARY_FOLDER, exist_ok=True)
+os.makedirs(BACKGROUND_CACHE_FOLDER, exist_ok=True)
+os.makedirs(JOB_WORKERS_FOLDER, exist_ok=True)
+
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+ASSET_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+upload_sessions_lock = threading.Lock() # Serializes manifest read-modify-write across parallel chunk PUTs
+recording_sessions = {} # recording id -> live ingest session (its ffmpeg process lives in this worker)
+recording_sessions_lock = threading.Lock()
+background_cache = OrderedDict() # In-memory LRU of fitted background arrays, most recently used last
+background_cache_lock = threading.Lock()
+glyph_atlases = {} # (font path, size, stroke width) -> GlyphAtlas
+text_layer_cache = OrderedDict() # In-memory LRU of finished RGBA text layers
+text_layer_cache_lock = threading.Lock()
+live_job_paths = set() # Absolute paths owned by running requests/jobs in this process; the janitor skips them
+live_job_paths_lock = threading.Lock()
+scratch_ram_reservations = {} # RAM tier scratch dir -> bytes its job may still write
+scratch_lock = threading.Lock()
+job_store_local = threading.local() # One SQLite connection per thread
+WORKER_ID = None # Identifies this process's jobs in the job store; assigned by start_worker()
+worker_lock_fd = None # Held (flock) for the life of the process; released by the OS when it dies
+worker_pid = None # PID of the process start_worker() ran in; a forked child differs and starts its own worker
+worker_start_lock = threading.Lock()
+render_io_pool = ThreadPoolExecutor(max_workers=RENDER_IO_WORKERS, thread_name_prefix='render-io')
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
 
 def allowed_file(filename, allowed_extensions):
     """Checks if a filename has an allowed extension."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
+def claim_paths(*paths):
+    """Marks files or directories as owned by a live job so the janitor leaves them alone."""
+    with live_job_paths_lock:
+        live_job_paths.update(os.path.abspath(path) for path in paths if path)
+
+def release_paths(*paths):
+    """Returns paths claimed with claim_paths() to the janitor's care."""
+    with live_job_paths_lock:
+        live_job_paths.difference_update(os.path.abspath(path) for path in paths if path)
+
+def ram_scratch_root():
+    """Returns the RAM tier root if it is configured and usable, creating it on first use, else None."""
+    root = app.config['SCRATCH_RAM_ROOT']
+    if not root or not os.path.isdir(os.path.dirname(root)):
+        return None
+    try:
+        os.makedirs(root, exist_ok=True)
+    except OSError:
+        return None
+    return root
+
+def allocate_scratch_dir(estimated_bytes):
+    """
+    Creates a claimed scratch directory for one job's intermediates. It goes to the RAM tier when the
+    job's estimate is within the per-job budget and the tmpfs has room for it on top of the reserve and
+    of what running jobs have already reserved there; otherwise to the disk tier.
+    """
+    name = uuid.uuid4().hex
+    with scratch_lock:
+        root = ram_scratch_root()
+        if root and estimated_bytes <= app.config['SCRATCH_RAM_JOB_MAX_BYTES']:
+            st = os.statvfs(root)
+            free_bytes = st.f_bavail * st.f_frsize - sum(scratch_ram_reservations.values())
+            if free_bytes - SCRATCH_RAM_RESERVE_BYTES >= estimated_bytes:
+                scratch_dir = os.path.join(root, name)
+                scratch_ram_reservations[scratch_dir] = estimated_bytes
+            else:
+                root = None
+        else:
+            root = None
+        if root is None:
+            scratch_dir = os.path.join(app.config['SCRATCH_DISK_ROOT'], name)
+    os.makedirs(scratch_dir)
+    claim_paths(scratch_dir)
+    logging.info(f"Allocated {'RAM' if root else 'disk'} scratch dir for ~{estimated_bytes} bytes: {scratch_dir}")
+    return scratch_dir
+
+def release_scratch_dir(scratch_dir):
+    """Deletes a scratch directory with everything left in it and returns its RAM reservation."""
+    if not scratch_dir:
+        return
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    with scratch_lock:
+        scratch_ram_reservations.pop(scratch_dir, None)
+    release_paths(scratch_dir)
+
+def sniff_media_kind(header_bytes):
+    """Returns 'audio', 'image' or 'captions' based on a file's leading bytes, or None if unrecognised."""
+    head = header_bytes[:UPLOAD_SNIFF_BYTES]
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'audio'
+    if head[:3] == b'ID3' or head[:4] in (b'OggS', b'fLaC', b'\x1a\x45\xdf\xa3'): # ID3 tagged MP3, Ogg, FLAC, WebM/Matroska
+        return 'audio'
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0: # MPEG audio frame sync or ADTS AAC
+        return 'audio'
+    if head[4:8] == b'ftyp': # MP4/M4A container (Safari's MediaRecorder output)
+        return 'audio'
+    if head[:8] == b'\x89PNG\r\n\x1a\n' or head[:3] == b'\xff\xd8\xff' or head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image'
+    text_head = head.lstrip(b'\xef\xbb\xbf').lstrip() # Optional UTF-8 BOM and leading blank lines
+    if text_head.startswith(b'WEBVTT') or text_head[:1].isdigit(): # WebVTT header or first SRT cue number
+        return 'captions'
+    return None
+
+class UploadRejected(Exception):
+    """Raised while streaming a multipart upload that breaks a limit or fails validation."""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def stream_multipart_upload(file_fields, upload_folder):
+    """
+    Streams the current multipart request body straight to disk in chunks instead of letting
+    Werkzeug buffer it first. file_fields maps each accepted file field name to a tuple of
+    (allowed extensions, expected media kind, label used in error messages).
+
+    Extensions are checked as soon as a part's headers arrive and magic bytes on its first bytes,
+    so bogus or oversized files are rejected before they cost disk space or decode time.
+    Returns (form, saved_files) where saved_files maps field name -> saved path.
+    Raises UploadRejected; any partially written files are removed before raising.
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadRejected('Expected a multipart/form-data request')
+
+    max_file_bytes = app.config['MAX_UPLOAD_FILE_BYTES']
+    max_request_bytes = app.config['MAX_CONTENT_LENGTH']
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+
+    form = {}
+    saved_files = {}
+    current_part = None
+    field_chunks = []
+    file_handle = None
+    file_path = None
+    file_bytes = 0
+    sniff_buffer = b''
+    request_bytes = 0
+
+    def open_file_part(part):
+        label = file_fields[part.name][2]
+        if not allowed_file(part.filename, file_fields[part.name][0]):
+            raise UploadRejected(f'{label} type not allowed')
+        return os.path.join(upload_folder, f"{uuid.uuid4()}_{secure_filename(part.filename)}")
+
+    try:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            request_bytes += len(chunk)
+            if max_request_bytes and request_bytes > max_request_bytes: # Also covers chunked transfer encoding
+                raise UploadRejected('Request body too large', 413)
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, File):
+                    current_part = event
+                    file_path = None
+                    file_bytes = 0
+                    sniff_buffer = b''
+                    if event.name in file_fields and event.filename:
+                        file_path = open_file_part(event) # Rejects disallowed extensions before any data is read
+                elif isinstance(event, Field):
+                    current_part = event
+                    field_chunks = []
+                elif isinstance(event, Data):
+                    if isinstance(current_part, Field):
+                        field_chunks.append(event.data)
+                        if sum(len(c) for c in field_chunks) > MAX_FORM_FIELD_BYTES:
+                            raise UploadRejected(f"Form field '{current_part.name}' too large", 413)
+                        if not event.more_data:
+                            form[current_part.name] = b''.join(field_chunks).decode('utf-8', 'replace')
+                    elif file_path:
+                        file_bytes += len(event.data)
+                        if file_bytes > max_file_bytes:
+                            raise UploadRejected(f'{file_fields[current_part.name][2]} too large', 413)
+                        if file_handle is None:
+                            # Hold back the first bytes until the magic signature can be checked
+                            sniff_buffer += event.data
+                            if len(sniff_buffer) >= UPLOAD_SNIFF_BYTES or not event.more_data:
+                                if sniff_media_kind(sniff_buffer) != file_fields[current_part.name][1]:
+                                    raise UploadRejected(f'{file_fields[current_part.name][2]} content does not match its type')
+                                claim_paths(file_path)
+                                file_handle = open(file_path, 'wb')
+                                saved_files[current_part.name] = file_path
+                                file_handle.write(sniff_buffer)
+                        else:
+                            file_handle.write(event.data)
+                        if not event.more_data:
+                            if file_handle is not None:
+                                file_handle.close()
+                                file_handle = None
+                                logging.info(f"Streamed upload '{current_part.name}' ({file_bytes} bytes) to: {file_path}")
+                            file_path = None
+                    # Data for unknown or empty file parts is discarded
+                event = decoder.next_event()
+
+            if not chunk or isinstance(event, Epilogue):
+                break
+    except (UploadRejected, RequestEntityTooLarge, ValueError) as e:
+        if file_handle is not None:
+            file_handle.close()
+        for path in saved_files.values():
+            if os.path.exists(path):
+                os.remove(path)
+        release_paths(*saved_files.values())
+        if isinstance(e, UploadRejected):
+            raise
+        if isinstance(e, RequestEntityTooLarge): # Content-Length over MAX_CONTENT_LENGTH
+            raise UploadRejected('Request body too large', 413)
+        raise UploadRejected(f'Malformed multipart body: {e}') # Raised by the decoder for malformed bodies
+
+    return form, saved_files
+
+def file_sha256(path):
+    """Returns the hex SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def audio_asset_meta(probe):
+    """Metadata recorded for an audio asset at ingest from its header probe, so its length is known without a decode."""
+    return {'duration_seconds': probe['duration'], 'duration_estimated': probe['duration_estimated']}
+
+def save_asset_meta(asset_id, meta):
+    """Atomically writes an asset's metadata."""
+    path = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, 'meta.json')
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+def add_asset_from_file(source_path, original_filename, kind, asset_id=None, **extra_meta):
+    """
+    Moves a finished upload into the asset library, keyed by the SHA-256 of its content (asset_id, if the
+    caller already hashed it). The file is renamed into place rather than copied; if the asset already
+    exists the source is dropped. extra_meta is stored in the asset's metadata; job_input=True marks a
+    one-off generate upload, which the janitor deletes once no active job needs it. Returns the asset id.
+    """
+    asset_id = asset_id or file_sha256(source_path)
+
+    asset_dir = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id)
+    extension = original_filename.rsplit('.', 1)[1].lower()
+    original_path = os.path.join(asset_dir, f"original.{extension}")
+    os.makedirs(asset_dir, exist_ok=True)
+    if os.path.exists(original_path):
+        os.remove(source_path)
+        meta = load_asset_meta(asset_id) or {}
+        if meta.get('job_input') and not extra_meta.get('job_input'): # Now added on purpose: kept for good
+            meta.pop('job_input')
+        save_asset_meta(asset_id, meta) # Also restarts the janitor's grace period of a job input
+        logging.info(f"Asset {asset_id} already in library, discarded duplicate upload.")
+    else:
+        shutil.move(source_path, original_path) # A rename unless the source is on another filesystem (tmpfs scratch)
+        save_asset_meta(asset_id, {'filename': original_filename, 'kind': kind, 'extension': extension,
+                                   'size': os.path.getsize(original_path), 'created_at': time.time(), **extra_meta})
+        logging.info(f"Stored asset {asset_id} at: {original_path}")
+    return asset_id
+
+def load_asset_meta(asset_id):
+    """Returns an asset's metadata, or None if the id is malformed or unknown."""
+    if not isinstance(asset_id, str) or not ASSET_ID_PATTERN.match(asset_id):
+        return None
+    try:
+        with open(os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, 'meta.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def get_asset_path(asset_id, kind):
+    """Returns the path of an asset's original file, or None if the id is unknown or of another kind."""
+    meta = load_asset_meta(asset_id)
+    if meta is None or meta.get('kind') != kind:
+        return None
+    return os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, f"original.{meta['extension']}")
+
+def save_asset_derivative(asset_id, name, array):
+    """Atomically stores a derived array (e.g. decoded PCM) next to an asset's original."""
+    path = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, name)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path) # Concurrent jobs deriving the same data simply overwrite each other
+    return path
+
+class AudioTooLong(Exception):
+    """Raised when a decode runs past MAX_AUDIO_DURATION_SECONDS, which an estimated duration cannot rule out up front."""
+
+def decode_audio(audio_path, probe=None, sample_format='f32le'):
+    """
+    Decodes an audio file to raw ASSET_PCM_SAMPLE_RATE, ASSET_PCM_CHANNELS PCM ('f32le' or 's16le') in a single
+    ffmpeg pass and returns it as a bytearray. The header probe (the preflight one when given) picks the cheapest
+    path: -ar and -ac are only added when the input's rate or channel count differ, so matching inputs are
+    neither resampled nor remixed. An exact duration also sizes the buffer ffmpeg's output is read straight
+    into, so the decoded track is held once rather than as pipe chunks plus their join; an estimated one
+    starts small and grows. Raises AudioTooLong, stopping ffmpeg, once the output passes the duration limit.
+    """
+    probe = probe or probe_audio(audio_path)
+    command = [FFMPEG_BINARY, '-v', 'error', '-i', audio_path, '-map', '0:a:0', '-f', sample_format]
+    if probe['sample_rate'] != ASSET_PCM_SAMPLE_RATE:
+        command += ['-ar', str(ASSET_PCM_SAMPLE_RATE)]
+    if probe['channels'] != ASSET_PCM_CHANNELS:
+        command += ['-ac', str(ASSET_PCM_CHANNELS)]
+    frame_bytes = (4 if sample_format == 'f32le' else 2) * ASSET_PCM_CHANNELS
+    max_seconds = app.config['MAX_AUDIO_DURATION_SECONDS']
+    limit_bytes = int(max_seconds * ASSET_PCM_SAMPLE_RATE) * frame_bytes + frame_bytes # One frame past the limit
+    # Size-based estimates can be many times too long, so only an exact duration sizes the buffer up front
+    initial_seconds = DECODE_INITIAL_BUFFER_SECONDS if probe['duration_estimated'] else probe['duration'] + 1 # A second of slack
+    buffer = bytearray(min(int(initial_seconds * ASSET_PCM_SAMPLE_RATE) * frame_bytes, limit_bytes))
+    size = 0
+    too_long = False
+    with subprocess.Popen(command + ['pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        # A damaged file can make ffmpeg log an error per packet; draining stderr on a thread keeps the pipe
+        # from filling up and stalling the decode, and only its last lines are kept for the error message
+        error_lines = deque(maxlen=FFMPEG_ERROR_TAIL_LINES)
+        drain = threading.Thread(target=error_lines.extend, args=(process.stderr,), daemon=True, name='ffmpeg-stderr')
+        drain.start()
+        while True:
+            if size == len(buffer): # The header's duration was short (or estimated)
+                if size == limit_bytes:
+                    too_long = True
+                    process.kill()
+                    break
+                buffer.extend(bytes(min(len(buffer) // 2 + frame_bytes, limit_bytes - len(buffer))))
+            read = process.stdout.readinto(memoryview(buffer)[size:])
+            if not read:
+                break
+            size += read
+        drain.join()
+    if too_long:
+        raise AudioTooLong(f"Audio is longer than the {max_seconds // 60} minute limit")
+    if process.returncode != 0:
+        error = b''.join(error_lines).decode(errors='replace').strip()
+        raise RuntimeError(f"ffmpeg failed to decode {os.path.basename(audio_path)}: {error}")
+    del buffer[size - size % frame_bytes:]
+    return buffer
+
+def decode_audio_pcm(audio_path, probe=None):
+    """Decodes an audio file to float32 PCM of shape (frames, ASSET_PCM_CHANNELS) at ASSET_PCM_SAMPLE_RATE."""
+    return np.frombuffer(decode_audio(audio_path, probe), dtype=np.float32).reshape((-1, ASSET_PCM_CHANNELS))
+
+def decode_audio_segment(audio_path, probe=None):
+    """Decodes an audio file straight into a 16-bit AudioSegment in the mix format, without a float32 copy."""
+    return AudioSegment(data=decode_audio(audio_path, probe, 's16le'), sample_width=2,
+                        frame_rate=ASSET_PCM_SAMPLE_RATE, channels=ASSET_PCM_CHANNELS)
+
+def load_asset_pcm(asset_id, probe=None):
+    """
+    Returns an audio asset as float32 PCM of shape (frames, ASSET_PCM_CHANNELS) at ASSET_PCM_SAMPLE_RATE.
+    The decode and resample happen once per asset; later calls memory-map the cached .npy. probe is the
+    asset's header probe, if the caller already has it.
+    """
+    name = f"pcm_{ASSET_PCM_SAMPLE_RATE}hz_{ASSET_PCM_CHANNELS}ch.npy"
+    path = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, name)
+    if not os.path.exists(path):
+        logging.info(f"Decoding audio asset {asset_id} into the PCM cache.")
+        save_asset_derivative(asset_id, name, decode_audio_pcm(get_asset_path(asset_id, 'audio'), probe))
+    return np.load(path, mmap_mode='r')
+
+def peaks_levels():
+    """Samples per pixel of each level of the peaks pyramid, finest first."""
+    return [PEAKS_BASE_SAMPLES_PER_PIXEL << level for level in range(PEAKS_LEVELS)]
+
+def build_asset_peaks(asset_id):
+    """
+    Builds an audio asset's min/max peaks pyramid in one pass over its cached PCM. The finest level
+    reduces all channels and PEAKS_BASE_SAMPLES_PER_PIXEL frames per pixel at once, block by block;
+    every coarser level then folds pairs of the previous level's pixels. Each level is stored next to
+    the asset as an int16 array of (min, max) rows.
+    """
+    pcm = load_asset_pcm(asset_id)
+    samples_per_pixel = PEAKS_BASE_SAMPLES_PER_PIXEL
+    peaks = np.empty((-(-len(pcm) // samples_per_pixel), 2), dtype=np.float32)
+    for start in range(0, len(pcm), PEAKS_BLOCK_FRAMES):
+        block = np.asarray(pcm[start:start + PEAKS_BLOCK_FRAMES])
+        padding = -len(block) % samples_per_pixel
+        if padding: # Repeating the last frame leaves the last pixel's min/max unchanged
+            block = np.concatenate([block, np.repeat(block[-1:], padding, axis=0)])
+        pixels = block.reshape(-1, samples_per_pixel * block.shape[1]) # Channels are folded in as well
+        first = start // samples_per_pixel
+        peaks[first:first + len(pixels), 0] = pixels.min(axis=1)
+        peaks[first:first + len(pixels), 1] = pixels.max(axis=1)
+
+    level = np.round(np.clip(peaks, -1.0, 1.0) * 32767).astype(np.int16)
+    for samples_per_pixel in peaks_levels():
+        if samples_per_pixel != PEAKS_BASE_SAMPLES_PER_PIXEL:
+            if len(level) % 2:
+                level = np.concatenate([level, level[-1:]])
+            pairs = level.reshape(-1, 2, 2)
+            level = np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1)
+        save_asset_derivative(asset_id, f"peaks_{samples_per_pixel}.npy", level)
+    logging.info(f"Built {PEAKS_LEVELS}-level peaks pyramid for asset {asset_id}")
+
+def load_asset_peaks(asset_id, samples_per_pixel):
+    """Returns one level of an asset's peaks pyramid as int16 (min, max) rows, building the pyramid once."""
+    path = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, f"peaks_{samples_per_pixel}.npy")
+    if not os.path.exists(path):
+        build_asset_peaks(asset_id)
+    return np.load(path, mmap_mode='r')
+
+def encode_peaks_dat(peaks, samples_per_pixel, bits):
+    """Encodes peaks as an audiowaveform .dat (version 1) file: a 20-byte header, then interleaved min/max."""
+    if bits == 8:
+        data = (np.asarray(peaks) >> 8).astype(np.int8)
+    else:
+        data = np.asarray(peaks, dtype='<i2')
+    header = struct.pack('<iIiiI', 1, 1 if bits == 8 else 0, ASSET_PCM_SAMPLE_RATE, samples_per_pixel, len(peaks))
+    return header + data.tobytes()
+
+def audio_segment_from_pcm(pcm, frame_rate):
+    """
+    Builds a 16-bit AudioSegment from float32 PCM of shape (frames, channels), converting block by block so no
+    float32 temporaries of the whole track are made.
+    """
+    int16_samples = np.empty(pcm.shape, dtype='<i2')
+    for start in range(0, len(pcm), ASSET_PCM_CONVERT_BLOCK_FRAMES):
+        block = np.clip(pcm[start:start + ASSET_PCM_CONVERT_BLOCK_FRAMES], -1.0, 1.0)
+        block *= 32767
+        int16_samples[start:start + ASSET_PCM_CONVERT_BLOCK_FRAMES] = block
+    return AudioSegment(data=int16_samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=pcm.shape[1])
+
+def load_audio_segment(audio_path, asset_id=None, probe=None):
+    """
+    Loads a track in the mix format. Library assets go through the asset PCM cache; one-off job inputs are
+    decoded directly to 16-bit, since a float32 cache of a track that is rendered once would only take disk
+    space. probe is the track's preflight header probe, which spares the decode another ffprobe run.
+    """
+    if asset_id and not (load_asset_meta(asset_id) or {}).get('job_input'):
+        return audio_segment_from_pcm(load_asset_pcm(asset_id, probe), ASSET_PCM_SAMPLE_RATE)
+    return decode_audio_segment(audio_path, probe)
+
+def fit_background_image(image, size, fit_mode, fill_rgb):
+    """
+    Fits a PIL image to size (width, height) with a single high-quality Lanczos resample.
+    'stretch' ignores the aspect ratio, 'cover' fills and centre-crops, 'contain' letterboxes with
+    fill_rgb, and 'crop' keeps native pixels and centre-crops (or pads) to the target size.
+    """
+    width, height = size
+    image = image.convert('RGB')
+    image_width, image_height = image.size
+    if fit_mode == 'cover':
+        scale = max(width / image_width, height / image_height)
+        crop_width, crop_height = width / scale, height / scale
+        left, top = (image_width - crop_width) / 2, (image_height - crop_height) / 2
+        # The box argument crops in source coordinates as part of the same resample
+        return image.resize((width, height), Image.LANCZOS, box=(left, top, left + crop_width, top + crop_height))
+    if fit_mode == 'contain':
+        scale = min(width / image_width, height / image_height)
+        fitted_size = (max(1, round(image_width * scale)), max(1, round(image_height * scale)))
+        canvas = Image.new('RGB', (width, height), fill_rgb)
+        canvas.paste(image.resize(fitted_size, Image.LANCZOS), ((width - fitted_size[0]) // 2, (height - fitted_size[1]) // 2))
+        return canvas
+    if fit_mode == 'crop':
+        canvas = Image.new('RGB', (width, height), fill_rgb)
+        canvas.paste(image, ((width - image_width) // 2, (height - image_height) // 2))
+        return canvas
+    return image.resize((width, height), Image.LANCZOS)
+
+def prune_background_disk_cache():
+    """Deletes least recently used on-disk background entries until the cache fits its byte budget."""
+    folder = app.config['BACKGROUND_CACHE_FOLDER']
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.npy') and '.tmp' not in name:
+            st = os.stat(os.path.join(folder, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_bytes <= BACKGROUND_CACHE_MAX_DISK_BYTES:
+            break
+        try:
+            os.remove(os.path.join(folder, name))
+            total_bytes -= size
+        except FileNotFoundError:
+            pass
+
+def load_background_image(image_path, size, fit_mode, fill_rgb, image_hash=None):
+    """
+    Returns a read-only RGB uint8 array of the image fitted to size, going through an in-memory LRU
+    and an on-disk cache keyed by image hash + size + fit mode, so repeated covers are never
+    decoded or resized twice. Pass image_hash when it is already known (e.g. asset ids).
+    """
+    width, height = size
+    image_hash = image_hash or file_sha256(image_path)
+    key = f"{image_hash}_{width}x{height}_{fit_mode}"
+    if fit_mode in BACKGROUND_FILL_MODES:
+        key += '_%02x%02x%02x' % tuple(fill_rgb)
+
+    with background_cache_lock:
+        if key in background_cache:
+            background_cache.move_to_end(key)
+            return background_cache[key]
+
+    disk_path = os.path.join(app.config['BACKGROUND_CACHE_FOLDER'], f"{key}.npy")
+    try:
+        rgb = np.load(disk_path)
+        os.utime(disk_path) # Marks the entry as recently used for disk pruning
+        logging.info(f"Background cache disk hit: {key}")
+    except FileNotFoundError:
+        logging.info(f"Background cache miss, fitting image to {width}x{height} ({fit_mode}).")
+        with Image.open(image_path) as image:
+            rgb = np.asarray(fit_background_image(image, size, fit_mode, fill_rgb))
+        tmp_path = f"{disk_path}.{uuid.uuid4().hex}.tmp.npy"
+        np.save(tmp_path, rgb)
+        os.replace(tmp_path, disk_path)
+        prune_background_disk_cache()
+
+    rgb.setflags(write=False) # Entries are shared between jobs
+    with background_cache_lock:
+        background_cache[key] = rgb
+        background_cache.move_to_end(key)
+        while len(background_cache) > BACKGROUND_CACHE_MAX_ENTRIES:
+            background_cache.popitem(last=False)
+    return rgb
+
+class GlyphAtlas:
+    """
+    Caches rasterized glyphs of one FreeType font at one size. Each glyph is rendered once as an
+    8-bit fill mask and an 8-bit fill+stroke mask, together with its offset from the line origin
+    and its advance, so text layers are assembled by blitting instead of re-rasterizing.
+    """
+    def __init__(self, font_path, font_size, stroke_width):
+        self.font = ImageFont.truetype(font_path, font_size)
+        self.stroke_width = stroke_width
+        ascent, descent = self.font.getmetrics()
+        self.line_height = ascent + descent
+        self.glyphs = {}
+        self.lock = threading.Lock()
+
+    def glyph(self, char):
+        """Returns (fill mask, stroke mask, (x offset, y offset), advance) for a character."""
+        with self.lock:
+            cached = self.glyphs.get(char)
+        if cached is not None:
+            return cached
+
+        left, top, right, bottom = self.font.getbbox(char, stroke_width=self.stroke_width)
+        size = (max(right - left, 0), max(bottom - top, 0))
+        fill_mask = np.zeros((size[1], size[0]), dtype=np.uint8)
+        stroke_mask = fill_mask
+        if size[0] and size[1]:
+            image = Image.new('L', size, 0)
+            ImageDraw.Draw(image).text((-left, -top), char, font=self.font, fill=255)
+            fill_mask = np.asarray(image)
+            if self.stroke_width:
+                image = Image.new('L', size, 0)
+                ImageDraw.Draw(image).text((-left, -top), char, font=self.font, fill=255,
+                                           stroke_width=self.stroke_width, stroke_fill=255)
+                stroke_mask = np.asarray(image)
+            else:
+                stroke_mask = fill_mask
+        cached = (fill_mask, stroke_mask, (left, top), self.font.getlength(char))
+        with self.lock:
+            self.glyphs[char] = cached
+        return cached
+
+    def measure(self, text):
+        """Returns the advance width of a single line of text."""
+        return sum(self.glyph(char)[3] for char in text)
+
+    def wrap(self, text, max_width):
+        """Splits text into lines on explicit newlines, then greedily on spaces to fit max_width."""
+        lines = []
+        for paragraph in text.splitlines() or ['']:
+            current = ''
+            for word in paragraph.split(' '):
+                candidate = f"{current} {word}" if current else word
+                if current and max_width and self.measure(candidate) > max_width:
+                    lines.append(current)
+                    current = word
+                else:
+                    current = candidate
+            lines.append(current)
+        return lines
+
+def get_glyph_atlas(font_path, font_size, stroke_width):
+    """Returns the shared glyph atlas for a font, size and stroke width."""
+    key = (font_path, font_size, stroke_width)
+    with text_layer_cache_lock:
+        if key not in glyph_atlases:
+            glyph_atlases[key] = GlyphAtlas(font_path, font_size, stroke_width)
+        return glyph_atlases[key]
+
+def default_font_path():
+    """Returns the configured overlay font, falling back to Matplotlib's bundled DejaVu Sans."""
+    return TEXT_OVERLAY_FONT_PATH or font_manager.findfont('DejaVu Sans')
+
+def render_text_layer(text, font_path, font_size, color_hex, stroke_color_hex, stroke_width, max_width=None, align='center'):
+    """
+    Rasterizes (possibly multi-line) text once into an RGBA uint8 layer, wrapping at max_width and
+    aligning lines left, center or right. Finished layers are cached by all their parameters,
+    so a recurring show title is never rasterized twice.
+    """
+    key = (text, font_path, font_size, color_hex, stroke_color_hex, stroke_width, max_width, align)
+    with text_layer_cache_lock:
+        if key in text_layer_cache:
+            text_layer_cache.move_to_end(key)
+            return text_layer_cache[key]
+
+    atlas = get_glyph_atlas(font_path, font_size, stroke_width)
+    lines = atlas.wrap(text, max_width)
+    line_widths = [atlas.measure(line) for line in lines]
+    layer_width = int(np.ceil(max(line_widths))) + 2 * stroke_width + 2
+    layer_height = len(lines) * atlas.line_height + (len(lines) - 1) * TEXT_OVERLAY_LINE_SPACING + 2 * stroke_width
+    fill_alpha = np.zeros((layer_height, layer_width), dtype=np.uint8)
+    stroke_alpha = np.zeros_like(fill_alpha)
+
+    for line_index, (line, line_width) in enumerate(zip(lines, line_widths)):
+        if align == 'left':
+            pen_x = stroke_width
+        elif align == 'right':
+            pen_x = layer_width - stroke_width - line_width
+        else:
+            pen_x = (layer_width - line_width) / 2
+        pen_y = stroke_width + line_index * (atlas.line_height + TEXT_OVERLAY_LINE_SPACING)
+        for char in line:
+            fill_mask, stroke_mask, (offset_x, offset_y), advance = atlas.glyph(char)
+            x, y = int(round(pen_x)) + offset_x, pen_y + offset_y
+            height, width = fill_mask.shape
+            # Clip glyphs that poke outside the layer (large negative bearings, tall accents)
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + width, layer_width), min(y + height, layer_height)
+            if x1 > x0 and y1 > y0:
+                region = (slice(y0, y1), slice(x0, x1))
+                glyph_region = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+                np.maximum(fill_alpha[region], fill_mask[glyph_region], out=fill_alpha[region])
+                np.maximum(stroke_alpha[region], stroke_mask[glyph_region], out=stroke_alpha[region])
+            pen_x += advance
+
+    # Fill colour over the stroke colour, weighted by the fill coverage
+    fill_weight = fill_alpha[..., None].astype(np.float32) / 255
+    rgb = np.asarray(hex_to_rgb(color_hex), dtype=np.float32) * fill_weight + \
+          np.asarray(hex_to_rgb(stroke_color_hex), dtype=np.float32) * (1 - fill_weight)
+    layer = np.dstack([rgb.astype(np.uint8), np.maximum(fill_alpha, stroke_alpha)])
+    layer.setflags(write=False) # Layers are shared between jobs
+
+    with text_layer_cache_lock:
+        text_layer_cache[key] = layer
+        while len(text_layer_cache) > TEXT_LAYER_CACHE_MAX_ENTRIES:
+            text_layer_cache.popitem(last=False)
+    return layer
+
+def blend_rgba_layer(base_rgb, layer_rgba, x, y):
+    """Returns a copy of base_rgb with layer_rgba alpha-blended at (x, y), clipped to the frame."""
+    result = np.array(base_rgb, dtype=np.uint8, copy=True)
+    frame_height, frame_width = result.shape[:2]
+    layer_height, layer_width = layer_rgba.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + layer_width, frame_width), min(y + layer_height, frame_height)
+    if x1 <= x0 or y1 <= y0:
+        return result
+    layer = layer_rgba[y0 - y:y1 - y, x0 - x:x1 - x]
+    alpha = layer[..., 3:4].astype(np.float32) / 255
+    region = result[y0:y1, x0:x1]
+    region[...] = (layer[..., :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+    return result
+
+CAPTION_TIMING_PATTERN = re.compile(
+    r'(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{3})\s*-->\s*(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{3})')
+CAPTION_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+def parse_captions(captions_path):
+    """Parses an SRT or WebVTT file into a list of (start seconds, end seconds, text) sorted by start."""
+    with open(captions_path, encoding='utf-8-sig', errors='replace') as f:
+        blocks = re.split(r'\n\s*\n', f.read().replace('\r\n', '\n'))
+    cues = []
+    for block in blocks:
+        lines = block.strip().split('\n')
+        for line_index, line in enumerate(lines):
+            match = CAPTION_TIMING_PATTERN.search(line)
+            if match:
+                parts = [int(part or 0) for part in match.groups()]
+                start = parts[0] * 3600 + parts[1] * 60 + parts[2] + parts[3] / 1000
+                end = parts[4] * 3600 + parts[5] * 60 + parts[6] + parts[7] / 1000
+                text = CAPTION_TAG_PATTERN.sub('', '\n'.join(lines[line_index + 1:])).strip()
+                if text and end > start:
+                    cues.append((start, end, text))
+                break
+    cues.sort(key=lambda cue: cue[0])
+    return cues
+
+def make_captioned_background_clip(background_rgb, cues, duration):
+    """
+    Returns a clip showing background_rgb with the active caption cue burned in.
+    Every cue is rasterized once up front through the text layer cache; the composed frame is
+    only rebuilt when playback crosses a cue boundary, all other frames reuse the same array.
+    """
+    video_height, video_width = background_rgb.shape[:2]
+    layers = [render_text_layer(text, default_font_path(), CAPTION_FONT_SIZE, CAPTION_COLOR,
+                                CAPTION_STROKE_COLOR, CAPTION_STROKE_WIDTH,
+                                max_width=int(video_width * CAPTION_MAX_WIDTH_RATIO))
+              for _, _, text in cues]
+    starts = np.array([start for start, _, _ in cues])
+    active = {'index': -1, 'frame': background_rgb}
+    lock = threading.Lock()
+
+    def frame_function(t):
+        index = int(np.searchsorted(starts, t, side='right')) - 1
+        if index >= 0 and t >= cues[index][1]:
+            index = -1 # Between cues
+        with lock:
+            if index != active['index']:
+                if index < 0:
+                    active['frame'] = background_rgb
+                else:
+                    layer = layers[index]
+                    active['frame'] = blend_rgba_layer(
+                        background_rgb, layer, (video_width - layer.shape[1]) // 2,
+                        video_height - int(video_height * CAPTION_BOTTOM_RATIO) - layer.shape[0])
+                active['index'] = index
+            return active['frame']
+
+    return VideoClip(frame_function, duration=duration)
+
+def mux_soft_subtitles(video_path, captions_path):
+    """Adds captions to an MP4 as a mov_text subtitle stream without re-encoding audio or video."""
+    muxed_path = f"{video_path}.subs.mp4"
+    command = [FFMPEG_BINARY, '-y', '-loglevel', 'error', '-i', video_path, '-i', captions_path,
+               '-map', '0', '-map', '1', '-c', 'copy', '-c:s', 'mov_text', '-movflags', '+faststart', muxed_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(muxed_path):
+            os.remove(muxed_path)
+        raise RuntimeError(f"ffmpeg subtitle mux failed: {result.stderr.strip()}")
+    os.replace(muxed_path, video_path)
+    logging.info(f"Muxed soft subtitles from {captions_path} into {video_path}")
+
+def file_range_body(path, start, length, file_size):
+    """
+    Returns a WSGI body for length bytes of a file starting at start. The server's wsgi.file_wrapper is
+    used whenever it is guaranteed to stop at the right byte, which lets servers such as gunicorn hand
+    the file to os.sendfile (zero-copy); other ranges are streamed in bounded chunks.
+    """
+    f = open(path, 'rb')
+    f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # gunicorn's sendfile honours Content-Length, other servers may send up to EOF
+    honours_length = request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+    if file_wrapper and (start + length == file_size or honours_length):
+        return file_wrapper(f, DOWNLOAD_READ_CHUNK_BYTES)
+
+    def generate():
+        remaining = length
+        try:
+            while remaining > 0:
+                data = f.read(min(DOWNLOAD_READ_CHUNK_BYTES, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            f.close()
+    return generate()
+
+def serve_generated_file(filename):
+    """
+    Serves a generated file with strong ETags (304 on If-None-Match), single byte ranges (206/416,
+    honouring If-Range), and optional X-Sendfile / X-Accel-Redirect offload to the front proxy.
+    """
+    path = safe_join(app.config['GENERATED_FILES_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        raise FileNotFoundError(filename)
+    st = os.stat(path)
+    # Generated files are written once and never modified, so size + mtime identify the content
+    etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        # Playlists and segments are fetched by players, finished MP4s are downloaded
+        'Content-Disposition': 'inline' if path.endswith(('.m3u8', '.ts')) else f'attachment; filename="{os.path.basename(path)}"',
+        'Cache-Control': 'private, max-age=0, must-revalidate',
+    }
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    # Record the download in the file's atime (mtime, and with it the ETag, stays unchanged) for the
+    # janitor's least-recently-downloaded eviction; explicit utime works even on noatime mounts
+    os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    accel_prefix = app.config['DOWNLOAD_X_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix:
+        # nginx serves the bytes (ranges included) from its internal location
+        headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        return Response(status=200, headers=headers, content_type=content_type)
+    if app.config['DOWNLOAD_X_SENDFILE']:
+        headers['X-Sendfile'] = os.path.abspath(path)
+        return Response(status=200, headers=headers, content_type=content_type)
+
+    start, length, status = 0, st.st_size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    # A range only applies while the client's cached copy (If-Range) is still the current file
+    range_still_valid = 'If-Range' not in request.headers or if_range.etag == etag or \
+        (if_range.date is not None and if_range.date.timestamp() >= int(st.st_mtime))
+    # Multi-range requests are answered with the full file (200), which HTTP allows
+    if byte_range is not None and byte_range.units == 'bytes' and len(byte_range.ranges) == 1 and range_still_valid:
+        span = byte_range.range_for_length(st.st_size)
+        if span is None:
+            headers['Content-Range'] = f"bytes */{st.st_size}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        length, status = stop - start, 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{st.st_size}"
+
+    headers['Content-Length'] = str(length)
+    return Response(file_range_body(path, start, length, st.st_size), status=status, headers=headers,
+                    content_type=content_type, direct_passthrough=True)
+
+def upload_session_paths(upload_id):
+    """Returns the (data file, manifest) paths of a resumable upload session."""
+    folder = app.config['UPLOAD_SESSIONS_FOLDER']
+    return os.path.join(folder, f"{upload_id}.part"), os.path.join(folder, f"{upload_id}.json")
+
+def load_upload_session(upload_id):
+    """Reads a resumable upload manifest, or returns None if the session does not exist."""
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    try:
+        with open(upload_session_paths(upload_id)[1]) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_upload_session(session):
+    """Atomically rewrites a resumable upload manifest so a crash never leaves it half written."""
+    manifest_path = upload_session_paths(session['upload_id'])[1]
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(session, f)
+    os.replace(tmp_path, manifest_path)
+
+def upload_session_status(session):
+    """Builds the client-facing view of a resumable upload session."""
+    received = set(session['received'])
+    return {
+        'upload_id': session['upload_id'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'total_chunks': session['total_chunks'],
+        'received_chunks': sorted(received),
+        'missing_chunks': [i for i in range(session['total_chunks']) if i not in received],
+        'state': session['state'],
+    }
+
+def start_recording_session():
+    """
+    Starts a live recording: an ffmpeg process reading the recorder's container stream on stdin and
+    writing the filtered voice track, already in the asset PCM layout, as a WAV next to its log.
+    """
+    recording_id = uuid.uuid4().hex
+    session_dir = os.path.join(app.config['UPLOAD_SESSIONS_FOLDER'], f"recording_{recording_id}")
+    os.makedirs(session_dir)
+    output_path = os.path.join(session_dir, 'voice.wav')
+    with open(os.path.join(session_dir, 'ffmpeg.log'), 'wb') as log:
+        process = subprocess.Popen([FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                                    '-af', RECORDING_VOICE_FILTERS, '-ar', str(ASSET_PCM_SAMPLE_RATE),
+                                    '-ac', str(ASSET_PCM_CHANNELS), '-c:a', 'pcm_s16le', '-y', output_path],
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log)
+    session = {
+        'recording_id': recording_id,
+        'dir': session_dir,
+        'output_path': output_path,
+        'process': process,
+        'lock': threading.Lock(), # Chunks are fed to ffmpeg strictly in order
+        'next_index': 0,
+        'pending': {}, # index -> chunk that arrived ahead of an earlier one
+        'bytes': 0,
+        'state': 'recording',
+        'last_activity': time.time(),
+    }
+    with recording_sessions_lock:
+        recording_sessions[recording_id] = session
+    logging.info(f"Started live recording {recording_id}")
+    return session
+
+def recording_ffmpeg_error(session):
+    with open(os.path.join(session['dir'], 'ffmpeg.log'), errors='replace') as f:
+        return f.read().strip()[-500:] or f"ffmpeg exited with code {session['process'].returncode}"
+
+def feed_recording_chunk(session, index, data):
+    """
+    Queues a chunk and pipes every chunk that is now in order into ffmpeg. Must hold session['lock'].
+    Returns an error message, or None.
+    """
+    if index < session['next_index'] or index in session['pending']:
+        return None # A retried chunk that was already received
+    if index - session['next_index'] > RECORDING_MAX_PENDING_CHUNKS:
+        return f"Chunk {index} is too far ahead of chunk {session['next_index']}"
+    if session['bytes'] + len(data) > MAX_RECORDING_BYTES:
+        return 'Recording too large'
+    if index == 0 and sniff_media_kind(data) != 'audio':
+        return 'Recording content is not audio'
+    session['pending'][index] = data
+    session['bytes'] += len(data)
+    while session['next_index'] in session['pending']:
+        try:
+            session['process'].stdin.write(session['pending'].pop(session['next_index']))
+            session['process'].stdin.flush()
+        except (BrokenPipeError, ValueError): # ffmpeg gave up on the stream
+            session['process'].wait()
+            session['state'] = 'failed'
+            return f"Recording could not be decoded: {recording_ffmpeg_error(session)}"
+        session['next_index'] += 1
+    return None
+
+def discard_recording_session(session):
+    """Stops a recording's ffmpeg and deletes its files."""
+    with recording_sessions_lock:
+        recording_sessions.pop(session['recording_id'], None)
+    if session['process'].poll() is None:
+        session['process'].kill()
+        session['process'].wait()
+    remove_path(session['dir'])
+
+def expire_recording_sessions(now):
+    """Discards live recordings that stopped receiving chunks without being finished."""
+    with recording_sessions_lock:
+        sessions = list(recording_sessions.values())
+    for session in sessions:
+        if session['state'] == 'recording' and now - session['last_activity'] > RECORDING_IDLE_TIMEOUT_SECONDS:
+            with session['lock']:
+                session['state'] = 'abandoned'
+            discard_recording_session(session)
+            logging.info(f"Janitor discarded abandoned live recording {session['recording_id']}")
+
 def validate_color(color_hex):
     """Validates if a string is a valid hex color code."""
     if not isinstance(color_hex, str) or not color_hex.startswith('#'):
@@ -74,8 +1230,10 @@ def validate_float_range(value, min_val, max_val):
         return False
 
 def hex_to_rgb(hex_color):
-    """Converts a hex color string to an RGB tuple."""
+    """Converts a hex color string (#rrggbb, or the #rgb shorthand validate_color also accepts) to an RGB tuple."""
     hex_color = hex_color.lstrip('#')
+    if len(hex_color) == 3:
+        hex_color = ''.join(c * 2 for c in hex_color)
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
 def equalize_and_denoise_recorded_voice(audio_segment):
@@ -104,311 +1262,1623 @@ def equalize_and_denoise_recorded_voice(audio_segment):
 
     return processed_audio
 
-def generate_waveform_frames(audio_filepath, video_duration, fps, video_width, video_height, waveform_style, waveform_color_hex, temp_dir):
-    """Generates a sequence of waveform image frames using Matplotlib."""
-    logging.info(f"Generating waveform frames for {audio_filepath} with style {waveform_style}")
-    
+def waveform_bounding_box(waveform_style, video_width, video_height):
+    """
+    Returns the fixed (x, y, width, height) region of the video frame that a waveform style draws into.
+    Frames are rendered at exactly this size and composited at (x, y), so pixel work scales with the
+    area of the waveform rather than with the full video resolution.
+    """
+    if WAVEFORM_STYLES[waveform_style].square_box:
+        # The circle grows up to max_radius * WAVEFORM_AMPLITUDE_MULTIPLIER around the frame centre
+        max_radius_px = min(video_width, video_height) / 4 * WAVEFORM_AMPLITUDE_MULTIPLIER
+        side = int(np.ceil(2 * max_radius_px)) + 2 * WAVEFORM_CIRCLE_LINE_WIDTH
+        side = min(side, video_width, video_height)
+        side -= side % 2 # Even dimensions keep the box exactly centred and are friendlier to encoders
+        return ((video_width - side) // 2, (video_height - side) // 2, side, side)
+
+    # Other styles share a horizontal band centred vertically
+    band_height = int(video_height * WAVEFORM_BAND_HEIGHT_RATIO)
+    band_height -= band_height % 2
+    return (0, (video_height - band_height) // 2, video_width, band_height)
+
+def frame_sample_matrix(samples, num_frames, samples_per_frame):
+    """Lays out the samples of every video frame as one (num_frames, samples_per_frame) row, zero-padding the tail."""
+    needed = num_frames * samples_per_frame
+    if len(samples) < needed:
+        samples = np.concatenate([samples, np.zeros(needed - len(samples), dtype=samples.dtype)])
+    return samples[:needed].reshape(num_frames, samples_per_frame)
+
+def frame_sample_rows(samples, starts, window):
+    """The `window` samples from each start as one row each, zero past the end of the track: (len(starts), window)"""
+    positions = starts[:, None] + np.arange(window)
+    if not len(samples):
+        return np.zeros(positions.shape, dtype=np.float32)
+    rows = samples[np.minimum(positions, len(samples) - 1)]
+    rows[positions >= len(samples)] = 0
+    return rows
+
+def column_min_max(frame_samples, columns):
+    """
+    Reduces every row to the min and max of each of `columns` equal slices: the per-pixel-column envelope.
+    With more columns than samples, the samples are linearly interpolated across the columns instead.
+    """
+    sample_count = frame_samples.shape[1]
+    if columns > sample_count:
+        positions = np.clip((np.arange(columns) + 0.5) * sample_count / columns - 0.5, 0, sample_count - 1)
+        left = positions.astype(int)
+        right = np.minimum(left + 1, sample_count - 1)
+        fraction = (positions - left).astype(np.float32)
+        values = frame_samples[:, left] * (1 - fraction) + frame_samples[:, right] * fraction
+        return values, values
+    edges = np.linspace(0, sample_count, columns + 1).astype(int)[:-1]
+    return np.minimum.reduceat(frame_samples, edges, axis=1), np.maximum.reduceat(frame_samples, edges, axis=1)
+
+def catmull_rom_weights(control_points, output_points):
+    """
+    Weights (output_points, control_points) of a uniform Catmull-Rom spline through evenly spaced control
+    points, sampled at output_points evenly spaced positions. Interpolating is then one matrix product.
+    """
+    u = np.linspace(0, control_points - 1, output_points)
+    segment = np.minimum(u.astype(int), control_points - 2)
+    t = (u - segment)[:, None]
+    basis = 0.5 * np.hstack([-t + 2 * t**2 - t**3, 2 - 5 * t**2 + 3 * t**3, t + 4 * t**2 - 3 * t**3, -t**2 + t**3])
+    weights = np.zeros((output_points, control_points), dtype=np.float32)
+    rows = np.arange(output_points)
+    for offset in range(4): # Neighbours beyond the ends are clamped to the end points
+        np.add.at(weights, (rows, np.clip(segment + offset - 1, 0, control_points - 1)), basis[:, offset])
+    return weights
+
+def band_level_blocks(samples, sample_rate, centres, fft_size, bands, db_range):
+    """
+    Yields (first index, levels) for consecutive blocks of WAVEFORM_FFT_BLOCK of the given window centres: the
+    levels of `bands` log-spaced bands between WAVEFORM_SPECTRUM_MIN_HZ and WAVEFORM_SPECTRUM_MAX_HZ, each the
+    loudest FFT bin in its range, mapped to [0, 1] over db_range dB below full scale. Blocks bound the float
+    intermediates of long tracks.
+    """
+    half = fft_size // 2
+    padded = np.zeros(len(samples) + fft_size, dtype=np.float32)
+    padded[half:half + len(samples)] = samples
+    windows = np.lib.stride_tricks.sliding_window_view(padded, fft_size) # windows[c] is centred on sample c
+    window = np.hanning(fft_size).astype(np.float32)
+    edges = np.geomspace(WAVEFORM_SPECTRUM_MIN_HZ, min(WAVEFORM_SPECTRUM_MAX_HZ, sample_rate / 2), bands + 1)
+    bins = np.minimum(np.round(edges[:-1] * fft_size / sample_rate).astype(int), half) # Narrow low bands repeat a bin
+    centres = np.clip(centres, 0, len(samples))
+    for start in range(0, len(centres), WAVEFORM_FFT_BLOCK):
+        block = windows[centres[start:start + WAVEFORM_FFT_BLOCK]] * window
+        magnitudes = np.abs(np.fft.rfft(block, axis=1)) / (window.sum() / 2) # A full-scale sine peaks at 0 dB
+        levels = 20 * np.log10(np.maximum.reduceat(magnitudes, bins, axis=1) + 1e-10)
+        yield start, np.clip(1 + levels / db_range, 0, 1).astype(np.float32)
+
+def analysis_hops(samples):
+    """The track cut into consecutive WAVEFORM_ANALYSIS_HOP sample hops: (hops, WAVEFORM_ANALYSIS_HOP)"""
+    return frame_sample_matrix(samples, max(-(-len(samples) // WAVEFORM_ANALYSIS_HOP), 1), WAVEFORM_ANALYSIS_HOP)
+
+def track_feature_rms(samples, sample_rate):
+    """Loudness of every hop: (hops,)"""
+    return np.sqrt(np.mean(np.square(analysis_hops(samples)), axis=1))
+
+def track_feature_peak(samples, sample_rate):
+    """Peak amplitude of every hop: (hops,)"""
+    return np.max(np.abs(analysis_hops(samples)), axis=1)
+
+def track_feature_spectrum(samples, sample_rate):
+    """Levels of WAVEFORM_BAR_COUNT log-spaced bands around every hop: (hops, bands)"""
+    hop_count = max(-(-len(samples) // WAVEFORM_ANALYSIS_HOP), 1)
+    centres = (np.arange(hop_count) * WAVEFORM_ANALYSIS_HOP + WAVEFORM_ANALYSIS_HOP // 2)
+    spectrum = np.empty((hop_count, WAVEFORM_BAR_COUNT), dtype=np.float32)
+    for start, levels in band_level_blocks(samples, sample_rate, centres, WAVEFORM_SPECTRUM_FFT_SIZE,
+                                           WAVEFORM_BAR_COUNT, WAVEFORM_SPECTRUM_DB_RANGE):
+        spectrum[start:start + len(levels)] = levels
+    return spectrum
+
+def frame_feature_envelope(frame_samples, sample_rate, columns):
+    """Min and max of every pixel column of every frame: (frames, 2, columns)"""
+    return np.stack(column_min_max(frame_samples, columns), axis=1)
+
+# Features a style can ask for. Track features are computed once per track every WAVEFORM_ANALYSIS_HOP samples,
+# smoothed, then interpolated at the times a style samples them, so their cost does not depend on the fps:
+# name -> function(samples, sample_rate)
+WAVEFORM_TRACK_FEATURES = {
+    'rms': track_feature_rms,
+    'peak': track_feature_peak,
+    'spectrum': track_feature_spectrum,
+}
+# Frame features are computed from each batch of frames' own samples: name -> function(frame_samples, sample_rate, columns)
+WAVEFORM_FRAME_FEATURES = {
+    'envelope': frame_feature_envelope,
+}
+
+def smooth_attack_release(values, hop_seconds):
+    """
+    One-pole smoothing along axis 0 that follows rises with a WAVEFORM_ATTACK_SECONDS time constant and falls with
+    a WAVEFORM_RELEASE_SECONDS one, so levels jump up quickly and decay instead of flickering.
+    """
+    attack = np.float32(np.exp(-hop_seconds / WAVEFORM_ATTACK_SECONDS))
+    release = np.float32(np.exp(-hop_seconds / WAVEFORM_RELEASE_SECONDS))
+    smoothed = np.empty_like(values)
+    level = values[0]
+    for index, value in enumerate(values): # Sequential by nature; every step is vectorized across bands
+        level = value + np.where(value > level, attack, release) * (level - value)
+        smoothed[index] = level
+    return smoothed
+
+def interpolate_track(values, positions):
+    """Linearly interpolates values along axis 0 at fractional indices of any shape, holding the end values."""
+    positions = np.clip(positions, 0, len(values) - 1)
+    left = positions.astype(int)
+    right = np.minimum(left + 1, len(values) - 1)
+    fraction = (positions - left).astype(np.float32).reshape(positions.shape + (1,) * (values.ndim - 1))
+    return values[left] * (1 - fraction) + values[right] * fraction
+
+def amplitude_rows(values, height):
+    """Maps amplitudes in [-1, 1] to fractional pixel rows of a band `height` tall, centred and growing upwards."""
+    return (height - 1) / 2 - values * (height / 2) * WAVEFORM_AMPLITUDE_MULTIPLIER
+
+def fill_column_spans(alpha, top, bottom):
+    """Fills every column of every frame from fractional row top to bottom (both (frames, width)), antialiasing the ends."""
+    rows = np.arange(alpha.shape[1], dtype=np.float32)[None, :, None]
+    coverage = np.minimum(rows - top[:, None, :], bottom[:, None, :] - rows) + 0.5
+    np.clip(coverage * 255, 0, 255, out=coverage)
+    alpha[...] = coverage
+
+WAVEFORM_STYLES = {} # Style name -> WaveformStyle subclass; also the set of styles the generate endpoint accepts
+
+def register_waveform_style(name):
+    """Class decorator adding a WaveformStyle to WAVEFORM_STYLES."""
+    def register(style_class):
+        WAVEFORM_STYLES[name] = style_class
+        return style_class
+    return register
+
+class WaveformStyle:
+    """
+    A waveform style. `features` names the track or frame features it needs; render() receives them for a batch
+    of frames (a range of frame indices) and fills alpha, a (frames, height, width) uint8 coverage buffer drawn
+    in the waveform colour. Styles with paints_rgb also fill rgb, a (frames, height, width, 3) buffer, instead of
+    using that colour. Track features are sampled at the times sample_times() returns.
+    """
+    features = ()
+    square_box = False # Drawn in a centred square rather than a full-width band
+    paints_rgb = False
+    prepares_track = False # prepare() uses the track, which is then decimated to the analysis rate for it
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+
+    def prepare(self, samples, sample_rate, fps, num_frames):
+        """Called once with the whole analysis-rate track before any render() when prepares_track is set."""
+
+    @classmethod
+    def prepared_bytes(cls, width, height, num_frames):
+        """Memory prepare() keeps for the whole render, so admission control can count it."""
+        return 0
+
+    def sample_times(self, frame_times, frame_seconds):
+        """Times, in seconds, at which the batch's track features are sampled; by default each frame's midpoint."""
+        return frame_times
+
+    def render(self, frames, features, alpha, rgb):
+        raise NotImplementedError
+
+@register_waveform_style('bars')
+class BarsStyle(WaveformStyle):
+    """Mirrored bars at the smoothed peak level of their slice of the frame."""
+    features = ('peak',)
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        slot = width / WAVEFORM_BAR_COUNT
+        columns = np.arange(width)
+        self.column_bar = np.minimum((columns / slot).astype(int), WAVEFORM_BAR_COUNT - 1)
+        # Gaps between bars, split evenly on both sides of each bar
+        self.column_in_bar = np.abs(columns + 0.5 - (self.column_bar + 0.5) * slot) <= slot * WAVEFORM_BAR_FILL_RATIO / 2
+        # Midpoints of the bars' slices, as fractions of the frame from its midpoint
+        self.bar_offsets = (np.arange(WAVEFORM_BAR_COUNT) + 0.5) / WAVEFORM_BAR_COUNT - 0.5
+
+    def sample_times(self, frame_times, frame_seconds):
+        return frame_times[:, None] + self.bar_offsets[None, :] * frame_seconds
+
+    def bar_heights(self, features):
+        """Height of every bar of every frame, in [0, 1]: (frames, bars)"""
+        return features['peak']
+
+    def render(self, frames, features, alpha, rgb):
+        heights = self.bar_heights(features)[:, self.column_bar] * self.column_in_bar
+        top = amplitude_rows(heights, self.height)
+        fill_column_spans(alpha, top, self.height - 1 - top)
+
+@register_waveform_style('bars-history')
+class BarsHistoryStyle(BarsStyle):
+    """Mirrored bars scrolling to the left, each the smoothed peak level at its moment of the last WAVEFORM_BARS_HISTORY_SECONDS."""
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        # The rightmost bar is the frame's own moment
+        self.bar_ages = WAVEFORM_BARS_HISTORY_SECONDS * (WAVEFORM_BAR_COUNT - 1 - np.arange(WAVEFORM_BAR_COUNT)) / WAVEFORM_BAR_COUNT
+
+    def sample_times(self, frame_times, frame_seconds):
+        return frame_times[:, None] - self.bar_ages[None, :]
+
+@register_waveform_style('frequency-bars')
+class FrequencyBarsStyle(BarsStyle):
+    """Mirrored bars at the level of log-spaced frequency bands, bass on the left."""
+    features = ('spectrum',)
+
+    def sample_times(self, frame_times, frame_seconds):
+        return frame_times
+
+    def bar_heights(self, features):
+        return features['spectrum'] / WAVEFORM_AMPLITUDE_MULTIPLIER # A full-scale band fills the band height
+
+@register_waveform_style('lines')
+class LinesStyle(WaveformStyle):
+    """The per-pixel-column min/max envelope: every sample's extent, with as many columns as the box is wide."""
+    features = ('envelope',)
+
+    def render(self, frames, features, alpha, rgb):
+        envelope = features['envelope']
+        top = amplitude_rows(envelope[:, 1], self.height)
+        bottom = amplitude_rows(envelope[:, 0], self.height)
+        # Columns also reach their left neighbour's extent, like the polyline min, max, next min ... would
+        top[:, 1:] = np.minimum(top[:, 1:], top[:, :-1])
+        bottom[:, 1:] = np.maximum(bottom[:, 1:], bottom[:, :-1])
+        fill_column_spans(alpha, top - WAVEFORM_LINE_WIDTH / 2, bottom + WAVEFORM_LINE_WIDTH / 2)
+
+@register_waveform_style('smooth-lines')
+class SmoothLinesStyle(WaveformStyle):
+    """A Catmull-Rom spline through the signed peak of each of SMOOTH_LINES_CONTROL_POINTS slices of the frame."""
+    features = ('envelope',)
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        control_points = min(SMOOTH_LINES_CONTROL_POINTS, width)
+        self.slice_edges = np.linspace(0, width, control_points + 1).astype(int)[:-1]
+        self.spline = catmull_rom_weights(control_points, width).T
+
+    def render(self, frames, features, alpha, rgb):
+        envelope = features['envelope']
+        mins = np.minimum.reduceat(envelope[:, 0], self.slice_edges, axis=1)
+        maxs = np.maximum.reduceat(envelope[:, 1], self.slice_edges, axis=1)
+        peaks = np.where(np.abs(maxs) >= np.abs(mins), maxs, mins).astype(np.float32)
+        rows = amplitude_rows(peaks @ self.spline, self.height) # All frames splined in one product
+        previous = np.concatenate([rows[:, :1], rows[:, :-1]], axis=1)
+        fill_column_spans(alpha, np.minimum(rows, previous) - WAVEFORM_LINE_WIDTH / 2,
+                          np.maximum(rows, previous) + WAVEFORM_LINE_WIDTH / 2)
+
+@register_waveform_style('circles')
+class CirclesStyle(WaveformStyle):
+    """A ring pulsating with the frame's RMS amplitude."""
+    features = ('rms',)
+    square_box = True
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        rows, columns = np.mgrid[0:height, 0:width].astype(np.float32)
+        self.distance = np.hypot(columns - (width - 1) / 2, rows - (height - 1) / 2)
+        self.max_radius = (width - 2 * WAVEFORM_CIRCLE_LINE_WIDTH) / 2
+
+    def render(self, frames, features, alpha, rgb):
+        radius = np.minimum(features['rms'] * WAVEFORM_AMPLITUDE_MULTIPLIER, 1) * self.max_radius / WAVEFORM_AMPLITUDE_MULTIPLIER
+        coverage = WAVEFORM_CIRCLE_LINE_WIDTH / 2 + 0.5 - np.abs(self.distance[None] - radius[:, None, None])
+        np.clip(coverage * 255, 0, 255, out=coverage)
+        alpha[...] = coverage
+
+@register_waveform_style('spectrogram')
+class SpectrogramStyle(WaveformStyle):
+    """
+    A scrolling time-frequency heatmap, high frequencies on top. The whole track's STFT is colour-mapped once
+    into a strip SPECTROGRAM_COLUMNS_PER_FRAME columns per frame; each frame is the box-wide window of it
+    ending at that frame, so rendering a frame is a copy of a view.
+    """
+    paints_rgb = True
+    prepares_track = True
+
+    def prepare(self, samples, sample_rate, fps, num_frames):
+        columns = num_frames * SPECTROGRAM_COLUMNS_PER_FRAME
+        # Fractional samples per frame, rounded per column, so the strip never drifts from the audio
+        centres = np.round((np.arange(columns) + 0.5) * (sample_rate / fps) / SPECTROGRAM_COLUMNS_PER_FRAME).astype(int)
+        lut = (matplotlib.colormaps[SPECTROGRAM_COLORMAP](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+        # Before the track starts the window shows silence
+        self.strip = np.empty((self.height, self.width + columns, 3), dtype=np.uint8)
+        self.strip[:, :self.width] = lut[0]
+        for start, levels in band_level_blocks(samples, sample_rate, centres, SPECTROGRAM_FFT_SIZE,
+                                               self.height, SPECTROGRAM_DB_RANGE):
+            stop = self.width + start + len(levels)
+            self.strip[:, self.width + start:stop] = lut[(levels.T[::-1] * 255).astype(np.uint8)]
+
+    @classmethod
+    def prepared_bytes(cls, width, height, num_frames):
+        return height * (width + num_frames * SPECTROGRAM_COLUMNS_PER_FRAME) * 3 # The RGB strip
+
+    def render(self, frames, features, alpha, rgb):
+        alpha[...] = 255
+        for offset, index in enumerate(frames):
+            end = self.width + (index + 1) * SPECTROGRAM_COLUMNS_PER_FRAME
+            rgb[offset] = self.strip[:, end - self.width:end]
+
+def decimate_to_analysis_rate(samples, sample_rate):
+    """
+    Anti-alias filters and decimates mono float32 samples by the integer factor that brings sample_rate down to
+    WAVEFORM_ANALYSIS_RATE or just above. Polyphase: each of the factor phases of the input is convolved with its
+    share of a windowed-sinc FIR, so only the kept samples are computed. Returns (samples, new sample rate).
+    """
+    factor = max(int(sample_rate // WAVEFORM_ANALYSIS_RATE), 1)
+    if factor == 1:
+        return samples, sample_rate
+    half = WAVEFORM_DECIMATION_HALF_TAPS
+    taps = np.arange(-half * factor, half * factor + 1)
+    cutoff = WAVEFORM_DECIMATION_CUTOFF / (2 * factor) # In cycles per input sample
+    fir = (2 * cutoff * np.sinc(2 * cutoff * taps) * np.blackman(len(taps))).astype(np.float32)
+    fir /= fir.sum()
+
+    output_length = -(-len(samples) // factor)
+    padded = np.zeros(factor - 1 + output_length * factor, dtype=np.float32)
+    padded[factor - 1:factor - 1 + len(samples)] = samples
+    decimated = np.zeros(output_length + half, dtype=np.float32)
+    for phase in range(factor):
+        phase_samples = padded[factor - 1 - phase::factor][:output_length] # samples[n * factor - phase]
+        decimated += np.convolve(phase_samples, fir[phase::factor])[:output_length + half]
+    return decimated[half:], sample_rate / factor # Drops the filter's delay of `half` output samples
+
+def waveform_analysis_samples(audio):
+    """
+    Returns the mono float32 samples of a mixed segment at its own rate, scaled so the loudest one is +-1, and
+    that rate. Works on the mix in memory, so the exported soundtrack is never decoded again.
+    """
+    interleaved = audio.get_array_of_samples()
+    interleaved = np.frombuffer(interleaved, dtype=interleaved.typecode)
+    # Downmixed straight from the integer samples; the scale is dropped by the normalization below anyway
+    samples = interleaved.reshape((-1, audio.channels)).sum(axis=1, dtype=np.float32)
+    peak = np.max(np.abs(samples)) if len(samples) else 0
+    if peak > 0: # Silence stays at zero
+        samples /= peak
+    return samples, audio.frame_rate
+
+class WaveformFrameSource:
+    """
+    Serves a style's frames to MoviePy, rasterizing WAVEFORM_RENDER_BATCH_FRAMES frames at a time. Once started,
+    a producer thread renders the batches in order, up to WAVEFORM_RENDER_QUEUE_BATCHES ahead of the encoder,
+    so rasterizing overlaps compositing and encoding while memory stays flat. Frames asked for out of order are
+    rendered on the spot. The latest batch is kept, so a frame's colour and mask come from a single render.
+    """
+    def __init__(self, samples, sample_rate, fps, num_frames, bounding_box, waveform_style, waveform_color_hex):
+        _, _, self.width, self.height = bounding_box
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self.num_frames = max(num_frames, 1)
+        self.style = WAVEFORM_STYLES[waveform_style](self.width, self.height)
+        # Frame features see every sample at the full rate, so the envelope keeps the peaks between analysis
+        # samples. Only styles with track features or a prepare() pay for decimating to the analysis rate.
+        self.track_features = {}
+        track_feature_names = [name for name in self.style.features if name in WAVEFORM_TRACK_FEATURES]
+        if track_feature_names or self.style.prepares_track:
+            track_samples, track_rate = decimate_to_analysis_rate(samples, sample_rate)
+            if self.style.prepares_track:
+                self.style.prepare(track_samples, track_rate, fps, self.num_frames)
+            self.hop_seconds = WAVEFORM_ANALYSIS_HOP / track_rate
+            self.track_features = {name: smooth_attack_release(WAVEFORM_TRACK_FEATURES[name](track_samples, track_rate), self.hop_seconds)
+                                   for name in track_feature_names}
+            del track_samples
+        # Frame i starts at round(i * sample_rate / fps): the rate rarely divides by the fps (44100 / 24 = 1837.5),
+        # and a truncated frame length would make the frames fall further behind the audio as the track plays
+        self.samples = samples
+        self.frame_starts = np.round(np.arange(self.num_frames) * (sample_rate / fps)).astype(int)
+        self.frame_window = max(int(np.ceil(sample_rate / fps)), 1)
+        self.color_frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.color_frame[...] = hex_to_rgb(waveform_color_hex)
+        self.batch_start = None
+        self.alpha = self.rgb = None
+        self.batches = None # Queue of the producer thread, once started
+        self.next_queued = None # Start of the next batch the queue will deliver
+        self.stopped = threading.Event()
+
+    def _render(self, start):
+        """Renders the batch of frames beginning at start, returning (start, alpha, rgb)."""
+        stop = min(start + WAVEFORM_RENDER_BATCH_FRAMES, self.num_frames)
+        features = {}
+        if self.track_features:
+            times = self.style.sample_times((np.arange(start, stop) + 0.5) / self.fps, 1 / self.fps) # Frame midpoints
+            for name, values in self.track_features.items():
+                # Hop h covers [h, h + 1) hops of time, so its value sits at h + 0.5; nothing precedes the track
+                sampled = interpolate_track(values, times / self.hop_seconds - 0.5)
+                features[name] = sampled * (times >= 0).reshape(times.shape + (1,) * (sampled.ndim - times.ndim))
+        for name in self.style.features:
+            if name in WAVEFORM_FRAME_FEATURES:
+                frame_samples = frame_sample_rows(self.samples, self.frame_starts[start:stop], self.frame_window)
+                features[name] = WAVEFORM_FRAME_FEATURES[name](frame_samples, self.sample_rate, self.width)
+        alpha = np.zeros((stop - start, self.height, self.width), dtype=np.uint8)
+        rgb = np.empty((stop - start, self.height, self.width, 3), dtype=np.uint8) if self.style.paints_rgb else None
+        self.style.render(range(start, stop), features, alpha, rgb)
+        return start, alpha, rgb
+
+    def _produce(self, first_start):
+        try:
+            for start in range(first_start, self.num_frames, WAVEFORM_RENDER_BATCH_FRAMES):
+                item = self._render(start)
+                if not self._put(item):
+                    return
+        except Exception as e:
+            logging.error(f"Error rendering waveform frames: {e}", exc_info=True)
+            self._put(e) # Raised to the encoder when it reaches this batch
+
+    def _put(self, item):
+        """Queues an item, waiting while the queue is full; False once the source is closed."""
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def start(self):
+        """Starts the producer thread after the batch already rendered, if any."""
+        first_start = 0 if self.batch_start is None else self.batch_start + WAVEFORM_RENDER_BATCH_FRAMES
+        self.batches = queue.Queue(maxsize=WAVEFORM_RENDER_QUEUE_BATCHES)
+        self.next_queued = first_start
+        threading.Thread(target=self._produce, args=(first_start,), daemon=True, name='waveform-frames').start()
+
+    def close(self):
+        """Stops the producer thread; it exits within a queue timeout."""
+        self.stopped.set()
+
+    def _render_batch(self, index):
+        start = index - index % WAVEFORM_RENDER_BATCH_FRAMES
+        if start == self.batch_start:
+            return index - start
+        if self.batches is not None and self.next_queued is not None and self.next_queued <= start < self.num_frames:
+            while True: # Batches the encoder skipped over are dropped
+                item = self.batches.get()
+                if isinstance(item, Exception):
+                    self.next_queued = None
+                    raise item
+                self.next_queued = item[0] + WAVEFORM_RENDER_BATCH_FRAMES
+                if item[0] == start:
+                    break
+        else:
+            item = self._render(start)
+        self.batch_start, self.alpha, self.rgb = item
+        return index - start
+
+    def frame_index(self, t):
+        return min(int(t * self.fps + 1e-6), self.num_frames - 1)
+
+    def get_frame(self, t):
+        if not self.style.paints_rgb:
+            return self.color_frame
+        offset = self._render_batch(self.frame_index(t))
+        return self.rgb[offset]
+
+    def get_mask(self, t):
+        offset = self._render_batch(self.frame_index(t))
+        return self.alpha[offset] * np.float32(1 / 255)
+
+    def clip(self, duration):
+        """A VideoClip of the waveform box, masked by the rendered coverage."""
+        mask = VideoClip(self.get_mask, is_mask=True, duration=duration)
+        return VideoClip(self.get_frame, duration=duration).with_mask(mask)
+
+def make_waveform_source(audio_segment, video_duration, fps, bounding_box, waveform_style, waveform_color_hex):
+    """Analyses a mixed segment into the frame source of its waveform, sized to the style's bounding box."""
+    logging.info(f"Analysing waveform with style {waveform_style}")
+    samples, sample_rate = waveform_analysis_samples(audio_segment)
+    source = WaveformFrameSource(samples, sample_rate, fps, int(video_duration * fps), bounding_box,
+                                 waveform_style, waveform_color_hex)
+    logging.info(f"Waveform source ready: {source.num_frames} frames of {source.width}x{source.height}.")
+    return source
+
+PCM_SAMPLE_FORMATS = {1: 'u8', 2: 's16le', 3: 's24le', 4: 's32le'} # pydub sample width -> ffmpeg raw format
+
+def encode_audio_track(audio_segment, output_path):
+    """Encodes a mixed segment to an AAC track, piping its PCM straight into ffmpeg."""
+    command = [FFMPEG_BINARY, '-v', 'error', '-y',
+               '-f', PCM_SAMPLE_FORMATS[audio_segment.sample_width], '-ar', str(audio_segment.frame_rate),
+               '-ac', str(audio_segment.channels), '-i', 'pipe:0',
+               '-c:a', 'aac', '-b:a', AUDIO_TRACK_BITRATE, output_path]
+    result = subprocess.run(command, input=audio_segment.raw_data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode the soundtrack: {result.stderr.decode(errors='replace').strip()}")
+    logging.info(f"Soundtrack encoded to: {output_path}")
+
+def video_output_unit(output_path):
+    """Returns the top-level entry of generated_files that holds an output (the HLS directory or the MP4)."""
+    folder = os.path.abspath(app.config['GENERATED_FILES_FOLDER'])
+    relative = os.path.relpath(os.path.abspath(output_path), folder)
+    return os.path.join(folder, relative.split(os.sep)[0])
+
+def disk_usage_entry(path):
+    """Returns (total bytes, last used time, last modified time) of a file or a directory tree."""
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, max(st.st_atime, st.st_mtime), st.st_mtime
+    total_bytes, last_used, last_modified = 0, 0, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            total_bytes += st.st_size
+            last_used = max(last_used, st.st_atime, st.st_mtime)
+            last_modified = max(last_modified, st.st_mtime)
+    if not last_modified: # Empty directory
+        last_modified = last_used = os.stat(path).st_mtime
+    return total_bytes, last_used, last_modified
+
+def remove_path(path):
+    """Deletes a file or directory tree, ignoring entries that disappeared meanwhile."""
     try:
-        audio = AudioSegment.from_file(audio_filepath)
-        # Convert to raw audio data (mono for simpler visualization)
-        audio_data = np.array(audio.get_array_of_samples())
-        if audio.channels > 1:
-            # Simple mono conversion: average channels
-            audio_data = audio_data.reshape((-1, audio.channels)).mean(axis=1)
-
-        # Calculate total samples and samples per frame
-        total_samples = len(audio_data)
-        samples_per_frame = int(audio.frame_rate / fps)
-        num_frames = int(video_duration * fps)
-
-        frame_paths = []
-        # Use global max amplitude for consistent scaling across all frames
-        global_max_amplitude = np.max(np.abs(audio_data))
-        if global_max_amplitude == 0: global_max_amplitude = 1 # Avoid division by zero
-
-        for i in range(num_frames):
-            start_sample = i * samples_per_frame
-            end_sample = start_sample + samples_per_frame
-            
-            # Ensure we don't go out of bounds for the current frame's audio data
-            current_frame_audio_data = audio_data[start_sample:min(end_sample, total_samples)]
-            
-            # Create a new matplotlib figure for each frame
-            fig, ax = plt.subplots(figsize=(video_width / 100, video_height / 100), dpi=100) # Adjust figsize based on desired output resolution
-            
-            # Set background to transparent
-            fig.patch.set_alpha(0.0)
-            ax.patch.set_alpha(0.0)
-
-            # Remove axes, ticks, labels, and padding
-            ax.set_axis_off()
-            ax.margins(0,0)
-            ax.set_frame_on(False)
-            ax.set_xlim(0, video_width / 100) # Set x-limits to match figsize units
-            ax.set_ylim(-video_height / 200, video_height / 200) # Set y-limits to center waveform
-
-            if len(current_frame_audio_data) > 0:
-                # Normalize amplitude to a suitable range for plotting (e.g., -1 to 1 or 0 to 1)
-                normalized_amplitudes_plot = current_frame_audio_data / global_max_amplitude
-
-                if waveform_style == 'bars' or waveform_style == 'frequency-bars':
-                    # For bars, we can use a simplified representation of frequency or just amplitude bars
-                    # Let's use amplitude bars for simplicity and visual appeal
-                    num_bars = 100 # Number of bars to display
-                    bar_indices = np.linspace(0, len(normalized_amplitudes_plot) - 1, num_bars, dtype=int)
-                    bar_heights = normalized_amplitudes_plot[bar_indices]
-                    
-                    x_positions = np.linspace(0, video_width / 100, num_bars)
-                    ax.bar(x_positions, bar_heights * (video_height / 200) * WAVEFORM_AMPLITUDE_MULTIPLIER, width=(video_width / 100) / num_bars * 0.8, 
-                           color=waveform_color_hex, align='center', bottom=0)
-                    ax.bar(x_positions, bar_heights * (-video_height / 200) * WAVEFORM_AMPLITUDE_MULTIPLIER, width=(video_width / 100) / num_bars * 0.8, 
-                           color=waveform_color_hex, align='center', bottom=0) # Mirror for centered effect
-
-                elif waveform_style == 'lines' or waveform_style == 'smooth-lines':
-                    x_positions = np.linspace(0, video_width / 100, len(normalized_amplitudes_plot))
-                    ax.plot(x_positions, normalized_amplitudes_plot * (video_height / 200) * WAVEFORM_AMPLITUDE_MULTIPLIER, 
-                            color=waveform_color_hex, linewidth=2)
-                elif waveform_style == 'circles':
-                    # Represent as a pulsating circle based on RMS amplitude
-                    rms_amplitude = np.sqrt(np.mean(normalized_amplitudes_plot**2))
-                    max_radius = min(video_width, video_height) / 400 # Max radius relative to video size
-                    current_radius = rms_amplitude * max_radius * WAVEFORM_AMPLITUDE_MULTIPLIER
-                    
-                    circle = Circle((video_width / 200, video_height / 200), current_radius, 
-                                    color=waveform_color_hex, fill=False, linewidth=3)
-                    ax.add_patch(circle)
-                    ax.set_xlim(0, video_width / 100)
-                    ax.set_ylim(0, video_height / 100)
-                    ax.set_aspect('equal', adjustable='box') # Ensure circle is round
-                else:
-                    # Default to lines if style is unknown
-                    x_positions = np.linspace(0, video_width / 100, len(normalized_amplitudes_plot))
-                    ax.plot(x_positions, normalized_amplitudes_plot * (video_height / 200) * WAVEFORM_AMPLITUDE_MULTIPLIER, 
-                            color=waveform_color_hex, linewidth=2)
-
-            frame_path = os.path.join(temp_dir, f"frame_{i:05d}.png")
-            plt.savefig(frame_path, transparent=True, bbox_inches='tight', pad_inches=0)
-            plt.close(fig) # Close the figure to free memory
-            frame_paths.append(frame_path)
-        
-        logging.info(f"Generated {len(frame_paths)} waveform frames.")
-        return frame_paths
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def evict_generated_files(now):
+    """
+    Deletes generated videos older than GENERATED_FILES_MAX_AGE_SECONDS, then the least recently
+    downloaded ones until the folder fits GENERATED_FILES_MAX_BYTES. Outputs still being written are skipped.
+    """
+    folder = os.path.abspath(app.config['GENERATED_FILES_FOLDER'])
+    with live_job_paths_lock:
+        live = set(live_job_paths)
+    entries = []
+    live_bytes = 0 # Outputs being written still count against the budget
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            usage = disk_usage_entry(path)
+        except FileNotFoundError:
+            continue
+        if path in live:
+            live_bytes += usage[0]
+        else:
+            entries.append((path,) + usage)
+
+    max_age = app.config['GENERATED_FILES_MAX_AGE_SECONDS']
+    kept = []
+    for path, size, last_used, last_modified in entries:
+        if now - last_modified > max_age:
+            if remove_path(path):
+                logging.info(f"Janitor evicted expired video: {path}")
+        else:
+            kept.append((last_used, size, path))
+
+    total_bytes = live_bytes + sum(size for _, size, _ in kept)
+    for last_used, size, path in sorted(kept): # Least recently downloaded first
+        if total_bytes <= app.config['GENERATED_FILES_MAX_BYTES']:
+            break
+        if remove_path(path):
+            total_bytes -= size
+            logging.info(f"Janitor evicted least recently downloaded video: {path} ({size} bytes)")
+
+def sweep_orphaned_temp_data(now):
+    """Deletes upload and scratch leftovers (both tiers) that no live job owns, plus abandoned resumable uploads."""
+    with live_job_paths_lock:
+        live = set(live_job_paths)
+    folders = [app.config['UPLOAD_FOLDER'], app.config['SCRATCH_DISK_ROOT']]
+    if ram_scratch_root():
+        folders.append(ram_scratch_root())
+    for folder in folders:
+        for name in os.listdir(folder):
+            path = os.path.abspath(os.path.join(folder, name))
+            try:
+                if path in live or now - os.stat(path).st_mtime < TEMP_DATA_GRACE_SECONDS:
+                    continue
+            except FileNotFoundError:
+                continue
+            if remove_path(path):
+                logging.info(f"Janitor swept orphaned temp data: {path}")
+
+    sessions_folder = app.config['UPLOAD_SESSIONS_FOLDER']
+    for name in os.listdir(sessions_folder):
+        path = os.path.join(sessions_folder, name)
+        try:
+            if now - os.stat(path).st_mtime > UPLOAD_SESSION_MAX_AGE_SECONDS and remove_path(path):
+                logging.info(f"Janitor swept abandoned resumable upload file: {path}")
+        except FileNotFoundError:
+            continue
+
+def sweep_job_input_assets(now):
+    """
+    Deletes one-off generate uploads (job_input assets) with their derived files once no queued or rendering
+    job references them. Assets touched within TEMP_DATA_GRACE_SECONDS are kept, since the request storing
+    them may not have created its job yet.
+    """
+    active_asset_ids = set()
+    for job in job_store().execute("SELECT params FROM jobs WHERE status IN ('queued', 'rendering')"):
+        active_asset_ids.update(value for key, value in json.loads(job['params']).items() if key.endswith('_asset_id'))
+    folder = app.config['ASSET_LIBRARY_FOLDER']
+    for asset_id in os.listdir(folder):
+        meta = load_asset_meta(asset_id)
+        if not meta or not meta.get('job_input') or asset_id in active_asset_ids:
+            continue
+        try:
+            if now - os.stat(os.path.join(folder, asset_id, 'meta.json')).st_mtime < TEMP_DATA_GRACE_SECONDS:
+                continue
+        except FileNotFoundError:
+            continue
+        if remove_path(os.path.join(folder, asset_id)):
+            logging.info(f"Janitor deleted job input asset {asset_id}")
+
+def prune_job_store(now):
+    """Forgets expired idempotency keys, and finished jobs once their videos are past the generated files' maximum age."""
+    job_store().execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - app.config['IDEMPOTENCY_KEY_TTL_SECONDS'],))
+    deleted = job_store().execute("DELETE FROM jobs WHERE status IN ('completed', 'failed', 'rejected', 'too_long') AND updated_at < ?",
+                                  (now - app.config['GENERATED_FILES_MAX_AGE_SECONDS'],)).rowcount
+    if deleted:
+        logging.info(f"Janitor pruned {deleted} finished jobs from the job store")
+
+def run_janitor_pass():
+    """Runs one eviction and sweep pass; errors are logged so the janitor thread keeps running."""
+    now = time.time()
+    try:
+        evict_generated_files(now)
+        sweep_orphaned_temp_data(now)
+        sweep_job_input_assets(now)
+        prune_job_store(now)
+        expire_recording_sessions(now)
+    except Exception as e:
+        logging.error(f"Janitor pass failed: {e}", exc_info=True)
+
+def start_janitor():
+    """Starts the background janitor thread: one pass right away (startup sweep), then one per interval."""
+    def loop():
+        while True:
+            run_janitor_pass()
+            time.sleep(JANITOR_INTERVAL_SECONDS)
+    threading.Thread(target=loop, name='janitor', daemon=True).start()
+    logging.info(f"Janitor started (every {JANITOR_INTERVAL_SECONDS} s).")
+
+def probe_audio(audio_path):
+    """
+    Reads an audio file's container header with ffprobe, without decoding it. Returns the first audio stream's
+    {'codec', 'channels', 'sample_rate', 'duration', 'duration_estimated'}; files whose header carries no
+    duration (e.g. MediaRecorder WebM) get one estimated from their size. Raises ValueError if the file is
+    unreadable or has no audio stream.
+    """
+    command = [get_prober_name(), '-v', 'error', '-select_streams', 'a:0',
+               '-show_entries', 'stream=codec_name,channels,sample_rate,duration:format=duration',
+               '-of', 'json', audio_path]
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=PROBE_TIMEOUT_SECONDS)
+        info = json.loads(result.stdout or b'{}') if result.returncode == 0 else {}
+    except (subprocess.TimeoutExpired, ValueError):
+        info = {}
+    streams = info.get('streams') or []
+    if not streams:
+        raise ValueError(f"Could not probe audio file: {os.path.basename(audio_path)}")
+    stream = streams[0]
+    probe = {'codec': stream.get('codec_name'), 'channels': int(stream.get('channels') or 0),
+             'sample_rate': int(stream.get('sample_rate') or 0), 'duration_estimated': False}
+    try:
+        probe['duration'] = float(stream.get('duration') or (info.get('format') or {}).get('duration'))
+    except (TypeError, ValueError):
+        probe['duration'] = os.path.getsize(audio_path) / PROBE_FALLBACK_BYTES_PER_SECOND
+        probe['duration_estimated'] = True
+    return probe
+
+def audio_probe_error(probe):
+    """Returns why a probed input cannot be rendered as (message, status code), or None if it can."""
+    if probe['codec'] not in SUPPORTED_AUDIO_CODECS:
+        return f"Unsupported audio codec '{probe['codec']}'", 400
+    if not 0 < probe['channels'] <= MAX_AUDIO_CHANNELS or not probe['sample_rate']:
+        return 'Unsupported audio channel layout or sample rate', 400
+    max_duration = app.config['MAX_AUDIO_DURATION_SECONDS']
+    if probe['duration'] > max_duration and not probe['duration_estimated']: # Size guesses can be far off
+        return f"Audio is longer than the {max_duration // 60} minute limit", 413
+    return None
+
+def estimate_render_cost(duration_seconds, track_durations=(), waveform_style=None,
+                         width=VIDEO_WIDTH, height=VIDEO_HEIGHT, fps=VIDEO_FPS):
+    """
+    Estimates what a render costs the admission controller: encoder threads, memory and wall-clock seconds.
+    track_durations are the full lengths of the input tracks, which are decoded whole even for a preview;
+    waveform_style adds whatever whole-track data the style prepares.
+    """
+    pixel_frames = duration_seconds * width * height * fps
+    style_bytes = 0
+    if waveform_style:
+        _, _, box_width, box_height = waveform_bounding_box(waveform_style, width, height)
+        style_bytes = WAVEFORM_STYLES[waveform_style].prepared_bytes(box_width, box_height, int(duration_seconds * fps))
+    return {
+        'cpu_threads': min(RENDER_ENCODE_THREADS, app.config['ADMISSION_CPU_THREADS']),
+        'ram_bytes': int(RENDER_BASE_RAM_BYTES + duration_seconds * RENDER_AUDIO_RAM_BYTES_PER_SECOND
+                         + sum(track_durations) * DECODED_TRACK_RAM_BYTES_PER_SECOND + style_bytes
+                         + width * height * 4 * fps), # About a second of RGBA frames in flight
+        'seconds': pixel_frames / RENDER_PIXEL_FRAMES_PER_SECOND,
+    }
+
+class AdmissionRejected(Exception):
+    """Raised when a render cannot be admitted; retry_after is a hint in seconds for the Retry-After header."""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Admits renders while the sum of their estimated costs fits the global CPU and RAM budgets, and
+    schedules the queued ones. Only the render picked by the scheduling policy may start next, so
+    large renders cannot be bypassed forever; aging makes them move up while they wait. Once the
+    queue is full new renders are rejected right away. An idle controller always admits one render.
+
+    Running full renders call checkpoint() regularly; when a preview is waiting for CPU the most
+    expensive one is asked to pause there, goes back to the queue and resumes once rescheduled. A paused
+    render keeps its decoded audio, frame buffers and encoder process, so only its CPU threads are freed:
+    its memory stays reserved, and previews that would not fit in memory never preempt.
+    """
+    def __init__(self, cpu_threads, ram_bytes, max_queued):
+        self.cpu_threads = cpu_threads
+        self.ram_bytes = ram_bytes
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.running = {} # ticket -> job
+        self.queued = {} # ticket -> job
+        self.preempt_requested = set() # Running tickets asked to pause at their next checkpoint
+        self.samples = {policy: {'queue_wait': deque(maxlen=SCHEDULER_STATS_SAMPLES),
+                                 'turnaround': deque(maxlen=SCHEDULER_STATS_SAMPLES)} for policy in SCHEDULER_POLICIES}
+
+    def _held_ram_bytes(self, ticket=None):
+        """Memory of the running renders plus that still held by paused ones (other than ticket)."""
+        return (sum(job['cost']['ram_bytes'] for job in self.running.values()) +
+                sum(job['cost']['ram_bytes'] for t, job in self.queued.items() if job.get('paused') and t != ticket))
+
+    def _fits(self, cost, ticket=None):
+        ram_bytes = self._held_ram_bytes(ticket)
+        if not self.running and not ram_bytes:
+            return True
+        return (sum(job['cost']['cpu_threads'] for job in self.running.values()) + cost['cpu_threads'] <= self.cpu_threads
+                and ram_bytes + cost['ram_bytes'] <= self.ram_bytes)
+
+    def _retry_after(self):
+        """Seconds until the running and queued work is estimated to drain at the current parallelism."""
+        now = time.monotonic()
+        remaining = sum(max(0, job['cost']['seconds'] - (now - job['started_at'])) for job in self.running.values())
+        remaining += sum(job['cost']['seconds'] for job in self.queued.values())
+        return max(1, math.ceil(remaining / max(1, len(self.running))))
+
+    def _next_ticket(self):
+        """The queued ticket the current policy starts next: previews first, then by policy."""
+        now = time.monotonic()
+        policy = app.config['SCHEDULER_POLICY']
+        client_seconds = {}
+        for job in self.running.values():
+            client_seconds[job['client']] = client_seconds.get(job['client'], 0) + job['cost']['seconds']
+
+        def priority(item):
+            _, job = item
+            aged_seconds = job['cost']['seconds'] - SCHEDULER_AGING_RATE * (now - job['submitted_at'])
+            if policy == 'fifo':
+                key = (job['submitted_at'],)
+            elif policy == 'sjf':
+                key = (aged_seconds,)
+            else:
+                key = (client_seconds.get(job['client'], 0), aged_seconds)
+            return (not job['preview'],) + key
+        if not self.queued:
+            return None
+        ticket = min(self.queued.items(), key=priority)[0]
+        if not self.running and not self._fits(self.queued[ticket]['cost'], ticket):
+            # Nothing runs, so only memory held by paused renders blocks the pick: one of them resumes first
+            paused = [item for item in self.queued.items() if item[1].get('paused')]
+            ticket = min(paused, key=priority)[0]
+        return ticket
+
+    def _request_preemption(self, job):
+        """
+        Asks the running full render with the most work left to pause, unless one already is. Pausing only
+        frees CPU threads, so nothing is paused for a preview that would not fit in memory anyway.
+        """
+        if not job['preview'] or self.preempt_requested:
+            return
+        if self._held_ram_bytes() + job['cost']['ram_bytes'] > self.ram_bytes:
+            return
+        candidates = [(job['cost']['seconds'], ticket) for ticket, job in self.running.items() if not job['preview']]
+        if candidates:
+            ticket = max(candidates)[1]
+            self.preempt_requested.add(ticket)
+            logging.info(f"Preview waiting, asking render {ticket} to pause at its next checkpoint")
+
+    def enqueue(self, cost, client, preview=False, force=False):
+        """Queues a render and returns its ticket; raises AdmissionRejected if the queue is full, unless forced."""
+        with self.condition:
+            if len(self.queued) >= self.max_queued and not force:
+                raise AdmissionRejected('Render queue is full, try again later', self._retry_after())
+            ticket = uuid.uuid4().hex
+            now = time.monotonic()
+            self.queued[ticket] = {'cost': cost, 'client': client, 'preview': preview,
+                                   'policy': app.config['SCHEDULER_POLICY'],
+                                   'submitted_at': now, 'queued_at': now, 'waited': 0.0}
+            self.condition.notify_all() # The new render may be the scheduler's next pick
+            return ticket
+
+    def wait(self, ticket, timeout=None):
+        """Blocks until the ticket is scheduled and fits the budgets. On timeout the ticket is dropped and AdmissionRejected raised."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            if ticket in self.running: # Already admitted
+                return
+            job = self.queued[ticket]
+            while not (self._next_ticket() == ticket and self._fits(job['cost'], ticket)):
+                if self._next_ticket() == ticket:
+                    self._request_preemption(job)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    del self.queued[ticket]
+                    self.condition.notify_all()
+                    raise AdmissionRejected('Server is busy rendering, try again later', self._retry_after())
+                self.condition.wait(remaining)
+            del self.queued[ticket]
+            job.pop('paused', None)
+            job['started_at'] = time.monotonic()
+            job['waited'] += job['started_at'] - job['queued_at']
+            self.running[ticket] = job
+            self.condition.notify_all() # The next pick may fit as well
+
+    def checkpoint(self, ticket):
+        """Called by running renders between units of work; pauses the render here if a preview needs its CPU threads."""
+        if ticket not in self.preempt_requested: # Cheap check without the lock on the hot path
+            return
+        with self.condition:
+            self.preempt_requested.discard(ticket)
+            job = self.running.pop(ticket)
+            job['queued_at'] = time.monotonic()
+            job['paused'] = True # Its memory stays reserved until it resumes or is released
+            self.queued[ticket] = job
+            self.condition.notify_all()
+        logging.info(f"Render {ticket} paused for a preview")
+        self.wait(ticket)
+        logging.info(f"Render {ticket} resumed")
+
+    def release(self, ticket):
+        """Frees a running or queued ticket's budget, records its timings and wakes the waiting renders."""
+        with self.condition:
+            job = self.running.pop(ticket, None)
+            self.queued.pop(ticket, None)
+            self.preempt_requested.discard(ticket)
+            if job:
+                samples = self.samples[job['policy']]
+                samples['queue_wait'].append(job['waited'])
+                samples['turnaround'].append(time.monotonic() - job['submitted_at'])
+            self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            return {'running': len(self.running), 'queued': len(self.queued)}
+
+    def stats(self):
+        """Queue-wait and turnaround percentiles (seconds) of the latest finished renders, per policy."""
+        with self.condition:
+            samples = {policy: {name: list(values) for name, values in s.items()} for policy, s in self.samples.items()}
+            status = {'policy': app.config['SCHEDULER_POLICY'], 'running': len(self.running), 'queued': len(self.queued)}
+        status['policies'] = {}
+        for policy, series in samples.items():
+            status['policies'][policy] = {'renders': len(series['turnaround'])}
+            for name, values in series.items():
+                status['policies'][policy][name] = {
+                    f"p{q}": round(float(np.percentile(values, q)), 3) if values else None for q in (50, 90, 99)}
+        return status
+
+def parse_generate_request(form, saved_files):
+    """
+    Validates a generate request's form fields and resolves its inputs, which are either streamed
+    uploads or asset library ids. Runs before any decoding so bad requests fail cheaply.
+    Returns (params, None) on success or (None, (response body, status code)) on failure.
+    """
+    uploaded_audio_path = saved_files.get('uploadedAudio')
+    recorded_audio_path = saved_files.get('recordedAudio')
+    background_image_filepath = saved_files.get('backgroundImage')
+
+    # Inputs can also reference the asset library instead of being uploaded again, which also
+    # skips their decode and resize. Asset files are never part of saved_files' cleanup.
+    uploaded_audio_asset_id = None if uploaded_audio_path else form.get('uploadedAudioAssetId')
+    if uploaded_audio_asset_id:
+        uploaded_audio_path = get_asset_path(uploaded_audio_asset_id, 'audio')
+        if uploaded_audio_path is None:
+            logging.warning(f"Unknown uploaded audio asset: {uploaded_audio_asset_id}")
+            return None, ({'message': 'Uploaded audio asset not found'}, 404)
+    recorded_audio_asset_id = None if recorded_audio_path else form.get('recordedAudioAssetId')
+    if recorded_audio_asset_id:
+        recorded_audio_path = get_asset_path(recorded_audio_asset_id, 'audio')
+        if recorded_audio_path is None:
+            logging.warning(f"Unknown recorded audio asset: {recorded_audio_asset_id}")
+            return None, ({'message': 'Recorded audio asset not found'}, 404)
+    background_image_asset_id = None if background_image_filepath else form.get('backgroundImageAssetId')
+    if background_image_asset_id:
+        background_image_filepath = get_asset_path(background_image_asset_id, 'image')
+        if background_image_filepath is None:
+            logging.warning(f"Unknown background image asset: {background_image_asset_id}")
+            return None, ({'message': 'Background image asset not found'}, 404)
+
+    if not uploaded_audio_path and not recorded_audio_path:
+        logging.warning("No audio files provided for video generation.")
+        return None, ({'message': 'No audio files provided'}, 400)
+
+    # Extract and validate other parameters
+    waveform_style = form.get('waveformStyle')
+    waveform_color = form.get('waveformColor')
+    background_color_hex = form.get('backgroundColor')
+    background_opacity_str = form.get('backgroundOpacity')
+    playback_speed_str = form.get('playbackSpeed')
+    text_overlay = form.get('textOverlay', '')
+    audio_output_format = form.get('downloadFormat', 'mp3').lower() 
+    background_fit = form.get('backgroundFit', 'stretch')
+    text_align = form.get('textAlign', 'center')
+    captions_path = saved_files.get('captionsFile')
+    captions_mode = form.get('captionsMode', 'burn')
+    output_mode = form.get('outputMode', 'faststart')
+    render_mode = form.get('renderMode', 'full')
+
+    # Basic validation for other fields
+    if waveform_style not in WAVEFORM_STYLES:
+        logging.warning(f"Invalid waveform style: {waveform_style}")
+        return None, ({'message': 'Invalid waveform style'}, 400)
+    if not validate_color(waveform_color):
+        logging.warning(f"Invalid waveform color: {waveform_color}")
+        return None, ({'message': 'Invalid waveform color format'}, 400)
+    if not validate_color(background_color_hex):
+        logging.warning(f"Invalid background color: {background_color_hex}")
+        return None, ({'message': 'Invalid background color format'}, 400)
+    if not validate_float_range(background_opacity_str, 0.0, 1.0):
+        logging.warning(f"Invalid background opacity: {background_opacity_str}")
+        return None, ({'message': 'Invalid background opacity value (must be between 0 and 1)'}, 400)
+    if not validate_float_range(playback_speed_str, 0.1, 5.0): # Assuming reasonable speed range
+        logging.warning(f"Invalid playback speed: {playback_speed_str}")
+        return None, ({'message': 'Invalid playback speed value'}, 400)
+    if audio_output_format not in ['webm', 'wav', 'mp3', 'aac']: # Added aac as a common video audio codec
+        logging.warning(f"Invalid audio output format for video: {audio_output_format}")
+        return None, ({'message': 'Invalid audio output format for video'}, 400)
+    if background_fit not in BACKGROUND_FIT_MODES:
+        logging.warning(f"Invalid background fit mode: {background_fit}")
+        return None, ({'message': f"Invalid background fit mode (must be one of {', '.join(BACKGROUND_FIT_MODES)})"}, 400)
+    if text_align not in TEXT_ALIGNMENTS:
+        logging.warning(f"Invalid text alignment: {text_align}")
+        return None, ({'message': f"Invalid text alignment (must be one of {', '.join(TEXT_ALIGNMENTS)})"}, 400)
+    if captions_mode not in CAPTION_MODES:
+        logging.warning(f"Invalid captions mode: {captions_mode}")
+        return None, ({'message': f"Invalid captions mode (must be one of {', '.join(CAPTION_MODES)})"}, 400)
+    if output_mode not in VIDEO_OUTPUT_MODES:
+        logging.warning(f"Invalid output mode: {output_mode}")
+        return None, ({'message': f"Invalid output mode (must be one of {', '.join(VIDEO_OUTPUT_MODES)})"}, 400)
+    if render_mode not in RENDER_MODES:
+        logging.warning(f"Invalid render mode: {render_mode}")
+        return None, ({'message': f"Invalid render mode (must be one of {', '.join(RENDER_MODES)})"}, 400)
+    captions = parse_captions(captions_path) if captions_path else []
+    if captions_path and not captions:
+        logging.warning(f"Captions file has no cues: {captions_path}")
+        return None, ({'message': 'Captions file has no valid cues'}, 400)
+    if captions and captions_mode == 'soft' and output_mode != 'faststart':
+        # A subtitle stream can only be muxed into the finished MP4
+        return None, ({'message': "Soft captions require outputMode 'faststart'"}, 400)
+
+    # Probe the audio headers (no decode): unusable inputs are rejected and the render is costed before admission
+    track_durations = []
+    probes = {}
+    for prefix, path in (('uploaded_audio', uploaded_audio_path), ('recorded_audio', recorded_audio_path)):
+        if not path:
+            continue
+        try:
+            probe = probe_audio(path)
+        except ValueError as e:
+            logging.warning(str(e))
+            return None, ({'message': 'Audio file could not be read'}, 400)
+        probe_error = audio_probe_error(probe)
+        if probe_error:
+            logging.warning(f"Rejected audio input {path}: {probe_error[0]}")
+            return None, ({'message': probe_error[0]}, probe_error[1])
+        track_durations.append(probe['duration'])
+        probes[prefix] = probe
+    duration_seconds = max(track_durations)
+    if render_mode == 'preview':
+        duration_seconds = min(duration_seconds, PREVIEW_MAX_SECONDS)
+
+    return {
+        'uploaded_audio_path': uploaded_audio_path,
+        'uploaded_audio_asset_id': uploaded_audio_asset_id,
+        'uploaded_audio_probe': probes.get('uploaded_audio'), # Reused by the decode
+        'recorded_audio_path': recorded_audio_path,
+        'recorded_audio_asset_id': recorded_audio_asset_id,
+        'recorded_audio_probe': probes.get('recorded_audio'),
+        # Live recordings were already equalized and denoised while they were ingested
+        'recorded_audio_voice_processed': bool(recorded_audio_asset_id and
+                                               (load_asset_meta(recorded_audio_asset_id) or {}).get('voice_processed')),
+        'background_image_path': background_image_filepath,
+        'background_image_asset_id': background_image_asset_id,
+        'waveform_style': waveform_style,
+        'waveform_color': waveform_color,
+        'background_color': background_color_hex,
+        'background_opacity': float(background_opacity_str),
+        'playback_speed': float(playback_speed_str),
+        'text_overlay': text_overlay,
+        'text_align': text_align,
+        'audio_output_format': audio_output_format,
+        'background_fit': background_fit,
+        'captions': captions,
+        'captions_path': captions_path,
+        'captions_asset_id': None,
+        'captions_mode': captions_mode,
+        'output_mode': output_mode,
+        'render_mode': render_mode,
+        'duration_seconds': duration_seconds,
+        'cost': estimate_render_cost(duration_seconds, track_durations, waveform_style),
+    }, None
+
+def plan_video_output(output_mode):
+    """Returns (output path, download URL) of a new video in an output mode; HLS outputs get their own directory."""
+    video_id = f"waveform_video_{uuid.uuid4()}"
+    if output_mode == 'hls':
+        output_dir = os.path.join(app.config['GENERATED_FILES_FOLDER'], video_id)
+        os.makedirs(output_dir, exist_ok=True)
+        return os.path.join(output_dir, 'index.m3u8'), f"/api/v2/podcast/download/{video_id}/index.m3u8"
+    output_path = os.path.join(app.config['GENERATED_FILES_FOLDER'], f"{video_id}.mp4") # Always output MP4 video
+    return output_path, f"/api/v2/podcast/download/{video_id}.mp4"
+
+def video_ffmpeg_params(output_mode, output_path):
+    """
+    Returns the extra ffmpeg params of an output mode. 'faststart' moves the moov atom to the front of
+    the MP4; 'fragmented' and 'hls' are written progressively so the beginning of a long render can be
+    played while later parts are still encoding.
+    """
+    # Regular keyframes bound the fragment/segment length (and seeking granularity)
+    keyframes = ['-force_key_frames', f"expr:gte(t,n_forced*{VIDEO_SEGMENT_SECONDS})"]
+    if output_mode == 'hls':
+        return keyframes + ['-f', 'hls', '-hls_time', str(VIDEO_SEGMENT_SECONDS),
+                            '-hls_playlist_type', 'event', # Playlist is rewritten after every segment
+                            '-hls_segment_filename', os.path.join(os.path.dirname(output_path), 'segment_%05d.ts')]
+    if output_mode == 'fragmented':
+        return keyframes + ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+    return ['-movflags', '+faststart']
+
+def render_input_tracks(params):
+    """
+    The audio tracks of a render, as (path, asset id, preflight probe, gain in dB, whether it needs voice
+    processing). Jobs stored before probes were kept in params have none, and are probed again at decode.
+    """
+    tracks = []
+    if params['uploaded_audio_path']: # Background: quieter, under the voice
+        tracks.append((params['uploaded_audio_path'], params['uploaded_audio_asset_id'], params.get('uploaded_audio_probe'),
+                       BACKGROUND_AUDIO_VOLUME_DB, False))
+    if params['recorded_audio_path']: # Voice: equalized and denoised unless ingest already did it
+        tracks.append((params['recorded_audio_path'], params['recorded_audio_asset_id'], params.get('recorded_audio_probe'),
+                       0, not params['recorded_audio_voice_processed']))
+    return tracks
+
+def prepare_input_track(audio_path, asset_id, probe, gain_db, process_voice):
+    """Decodes one input track and applies its processing; runs on the render I/O pool, one task per track."""
+    segment = load_audio_segment(audio_path, asset_id, probe)
+    if process_voice:
+        segment = equalize_and_denoise_recorded_voice(segment)
+    if gain_db:
+        segment = segment + gain_db
+    return segment
+
+def mix_track(mix, segment):
+    """Overlays a track on the mix from the start, extending the mix with silence to the longer of the two."""
+    if mix is None:
+        return segment
+    if len(segment) > len(mix):
+        mix += AudioSegment.silent(duration=len(segment) - len(mix), frame_rate=mix.frame_rate)
+    return mix.overlay(segment, position=0)
+
+def estimate_render_scratch_bytes(duration_seconds):
+    """Upper estimate of a render's intermediates: the encoded soundtrack."""
+    return int(duration_seconds * SCRATCH_AUDIO_BYTES_PER_SECOND)
+
+def render_podcast_video(params, output_video_filepath, ffmpeg_params, checkpoint=None, on_stage=None):
+    """
+    Mixes the audio and renders the waveform video for validated params, cleaning up its temp files.
+    checkpoint, if given, is called between frames so the scheduler can pause the render there;
+    on_stage is called with the name of each stage as it starts.
+    """
+    checkpoint = checkpoint or (lambda: None)
+    on_stage = on_stage or (lambda stage: None)
+    scratch_dir = None
+    final_audio_segment = None
+    waveform_source = audio_track = None
+    output_unit = video_output_unit(output_video_filepath)
+    claim_paths(output_unit) # An output still being written must never be evicted
+
+    try:
+        on_stage('mixing')
+        # Every input track decodes and gets its own processing on the pool at once; they are mixed as they finish
+        track_futures = [render_io_pool.submit(prepare_input_track, *track) for track in render_input_tracks(params)]
+        for future in as_completed(track_futures):
+            final_audio_segment = mix_track(final_audio_segment, future.result())
+
+        if params['render_mode'] == 'preview':
+            final_audio_segment = final_audio_segment[:PREVIEW_MAX_SECONDS * 1000]
+
+        video_width, video_height = VIDEO_WIDTH, VIDEO_HEIGHT
+        video_fps = VIDEO_FPS
+        video_duration = final_audio_segment.duration_seconds
+        waveform_box = waveform_bounding_box(params['waveform_style'], video_width, video_height)
+
+        # The mixed duration sizes the job's intermediates, which picks its scratch tier (tmpfs or disk)
+        scratch_dir = allocate_scratch_dir(estimate_render_scratch_bytes(video_duration))
+
+        # 1. Encode the soundtrack in the background while the waveform is analysed and the frames are prepared;
+        # the video encoder copies it in as it is
+        audio_track_filepath = os.path.join(scratch_dir, 'audio_track.m4a')
+        audio_track = render_io_pool.submit(encode_audio_track, final_audio_segment, audio_track_filepath)
+
+        # 2. Analyse the waveform of the mix in memory, only for the style's bounding box.
+        # Frames are rasterized in batches while the encoder consumes them, so nothing is written to disk.
+        on_stage('frames')
+        waveform_source = make_waveform_source(
+            final_audio_segment, video_duration, video_fps, 
+            waveform_box, params['waveform_style'], params['waveform_color']
+        )
+        # The compositor only blends this rectangle into the background
+        waveform_clip = waveform_source.clip(video_duration).with_position(waveform_box[:2])
+
+        # 3. Create the background frame
+        if params['background_image_path']:
+            # Decoded and fitted once, then served from the background cache on repeated covers. The colour
+            # only matters to modes that leave a border around the image
+            fill_rgb = hex_to_rgb(params['background_color']) if params['background_fit'] in BACKGROUND_FILL_MODES else None
+            background_rgb = load_background_image(params['background_image_path'], (video_width, video_height),
+                                                   params['background_fit'], fill_rgb,
+                                                   image_hash=params['background_image_asset_id'])
+        else:
+            background_rgb = np.empty((video_height, video_width, 3), dtype=np.uint8)
+            background_rgb[...] = hex_to_rgb(params['background_color'])
+            # For opacity, MoviePy handles it when compositing if the top layer has alpha.
+            # For a solid color background, opacity is less relevant unless compositing with another video.
+
+        # 4. Bake the text overlay into the static background, so it is blended once instead of every frame
+        if params['text_overlay']:
+            text_layer = render_text_layer(params['text_overlay'], default_font_path(), TEXT_OVERLAY_FONT_SIZE,
+                                           TEXT_OVERLAY_COLOR, TEXT_OVERLAY_STROKE_COLOR, TEXT_OVERLAY_STROKE_WIDTH,
+                                           max_width=int(video_width * TEXT_OVERLAY_MAX_WIDTH_RATIO), align=params['text_align'])
+            background_rgb = blend_rgba_layer(background_rgb, text_layer,
+                                              (video_width - text_layer.shape[1]) // 2,
+                                              int(video_height * TEXT_OVERLAY_TOP_RATIO))
+
+        captions = params['captions']
+        if captions and params['captions_mode'] == 'burn':
+            background_clip = make_captioned_background_clip(background_rgb, captions, video_duration)
+        else:
+            background_clip = ImageClip(background_rgb).with_duration(video_duration)
+        all_clips = [background_clip, waveform_clip]
+
+        # Composite all clips
+        final_video_clip = CompositeVideoClip(all_clips, size=(video_width, video_height))
+
+        # Checkpoint before each encoded frame; a paused render just stalls the encoder pipe
+        final_video_clip = final_video_clip.transform(lambda get_frame, t: (checkpoint(), get_frame(t))[1])
 
+        # 5. Wait for the soundtrack, then write the final video file while the frames render ahead of the encoder
+        audio_track.result()
+        on_stage('encoding')
+        waveform_source.start()
+        # Use 'libx264' for video codec; the AAC soundtrack is copied, not re-encoded
+        final_video_clip.write_videofile(output_video_filepath, 
+                                        fps=video_fps, 
+                                        codec='libx264', 
+                                        audio=audio_track_filepath,
+                                        audio_codec='copy',
+                                        preset=PREVIEW_X264_PRESET if params['render_mode'] == 'preview' else 'medium',
+                                        ffmpeg_params=ffmpeg_params,
+                                        threads=RENDER_ENCODE_THREADS) # Use multiple threads for faster encoding
+        logging.info(f"Video generated successfully: {output_video_filepath}")
+
+        # Soft captions cost nothing at render time: they are muxed as a subtitle stream afterwards
+        if captions and params['captions_mode'] == 'soft':
+            on_stage('captions')
+            mux_soft_subtitles(output_video_filepath, params['captions_path'])
+    finally:
+        if waveform_source:
+            waveform_source.close()
+        if audio_track:
+            audio_track.exception() # The soundtrack encoder must be done with the scratch dir before it goes
+        if scratch_dir:
+            release_scratch_dir(scratch_dir)
+            logging.info(f"Cleaned up render scratch dir: {scratch_dir}")
+        release_paths(output_unit)
+
+def describe_render_error(e):
+    """Turns a rendering exception into the message returned to clients."""
+    # Check for FFmpeg specific errors
+    if "ffmpeg" in str(e).lower() and "not found" in str(e).lower():
+        return "FFmpeg is not installed or not accessible in your system's PATH. Please install FFmpeg."
+    return f'Video generation failed: {str(e)}.'
+
+def cleanup_saved_files(saved_files):
+    """Deletes the uploads a request or job owns."""
+    for field_name, saved_path in saved_files.items():
+        if os.path.exists(saved_path):
+            os.remove(saved_path)
+            logging.info(f"Cleaned up uploaded file '{field_name}': {saved_path}")
+    release_paths(*saved_files.values())
+
+def job_store():
+    """Returns this thread's connection to the SQLite job store (WAL, autocommit)."""
+    connection = getattr(job_store_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(app.config['JOB_STORE_PATH'], timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL') # Readers never block the writer (status polls during renders)
+        connection.execute('PRAGMA synchronous=NORMAL') # Durable across process crashes, which is what restarts are
+        job_store_local.connection = connection
+    return connection
+
+def init_job_store():
+    job_store().executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stage TEXT,
+            params TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            video_url TEXT NOT NULL,
+            output_mode TEXT NOT NULL,
+            client_id TEXT,
+            message TEXT,
+            worker_id TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash, status);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            client_id TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            job_id TEXT, -- NULL while the first request is still uploading
+            worker_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (client_id, idempotency_key)
+        );
+    """)
+
+def create_job(job_id, content_hash, params, output_path, video_url, client_id):
+    now = time.time()
+    stored_params = {key: value for key, value in params.items() if key != 'captions'} # Cues are re-parsed on resume
+    job_store().execute(
+        "INSERT INTO jobs (job_id, content_hash, status, params, output_path, video_url, output_mode, client_id,"
+        " worker_id, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, content_hash, json.dumps(stored_params), output_path, video_url, params['output_mode'],
+         client_id, WORKER_ID, now, now))
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    job_store().execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+def get_job(job_id):
+    return job_store().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+def find_completed_job(content_hash):
+    """Returns the latest completed job with this content hash whose video still exists, or None."""
+    for job in job_store().execute("SELECT * FROM jobs WHERE content_hash = ? AND status = 'completed'"
+                                   " ORDER BY updated_at DESC", (content_hash,)):
+        if os.path.exists(job['output_path']):
+            return job
+    return None
+
+def job_status(job):
+    """The client-facing view of a job row."""
+    return {key: job[key] for key in ('job_id', 'status', 'stage', 'video_url', 'output_mode', 'message',
+                                      'content_hash', 'created_at', 'updated_at')}
+
+def load_job_params(job):
+    params = json.loads(job['params'])
+    params['captions'] = parse_captions(params['captions_path']) if params['captions_path'] else []
+    return params
+
+def hash_job_inputs(params, saved_files):
+    """Sets the asset ids (content hashes) of a request's uploads in params, so its content hash covers them."""
+    for field_name, saved_path in saved_files.items():
+        params[f"{JOB_INPUT_FIELDS[field_name]}_asset_id"] = file_sha256(saved_path)
+
+def persist_job_inputs(params, saved_files):
+    """
+    Moves an admitted request's hashed uploads into the asset library as job inputs and points params at the
+    stored copies, so the job's inputs survive a restart. saved_files is emptied.
+    """
+    for field_name, saved_path in saved_files.items():
+        prefix = JOB_INPUT_FIELDS[field_name]
+        kind = UPLOAD_FILE_FIELDS[field_name][1]
+        original_filename = os.path.basename(saved_path).split('_', 1)[1] # Strip the uuid prefix
+        probe = params.get(f"{prefix}_probe")
+        asset_id = add_asset_from_file(saved_path, original_filename, kind, asset_id=params[f"{prefix}_asset_id"],
+                                       job_input=True, **(audio_asset_meta(probe) if probe else {}))
+        params[f"{prefix}_path"] = get_asset_path(asset_id, kind)
+    release_paths(*saved_files.values())
+    saved_files.clear()
+
+def job_content_hash(params):
+    """Hash of everything that determines a render's output: input asset ids and all options."""
+    identity = {key: value for key, value in params.items()
+                if not key.endswith(('_path', '_probe')) and key not in ('captions', 'cost', 'duration_seconds')}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+def hold_worker_lock():
+    """Takes this process's worker lock; other processes treat its jobs as live while the lock is held."""
+    global worker_lock_fd
+    lock_path = os.path.join(JOB_WORKERS_FOLDER, f"{WORKER_ID}.lock")
+    worker_lock_fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(worker_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(worker_lock_fd)
+        worker_lock_fd = None
+        raise RuntimeError(f"Worker lock {lock_path} is held by another process; worker ids must be unique per process")
+
+def worker_is_alive(worker_id):
+    """True while the worker process that owns worker_id still holds its lock file."""
+    if worker_id == WORKER_ID:
+        return True
+    try:
+        fd = os.open(os.path.join(JOB_WORKERS_FOLDER, f"{worker_id}.lock"), os.O_RDWR)
+    except (FileNotFoundError, TypeError):
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+def run_render_job(job_id, ticket, params, output_path, ffmpeg_params):
+    """
+    Renders a stored job once its ticket is admitted, persisting its stages and outcome, and frees the
+    ticket. Returns the final job row.
+    """
+    try:
+        admission.wait(ticket)
+        update_job(job_id, status='rendering')
+        render_podcast_video(params, output_path, ffmpeg_params, lambda: admission.checkpoint(ticket),
+                             on_stage=lambda stage: update_job(job_id, stage=stage))
+        update_job(job_id, status='completed', stage='done', message='Video generated successfully')
+    except AudioTooLong as e:
+        logging.warning(f"Render job {job_id} rejected: {e}")
+        update_job(job_id, status='too_long', message=str(e))
     except Exception as e:
-        logging.error(f"Error generating waveform frames: {e}", exc_info=True)
+        logging.error(f"Error during video generation for job {job_id}: {e}", exc_info=True)
+        update_job(job_id, status='failed', message=describe_render_error(e))
+    finally:
+        admission.release(ticket)
+    return get_job(job_id)
+
+def recover_interrupted_jobs():
+    """
+    Restarts the queued or rendering jobs of worker processes that are gone. Each job is claimed with a
+    conditional update, so when several workers boot at once only one of them picks it up. Partial
+    outputs are discarded and the render starts over from the stored inputs.
+    """
+    dead_workers = set()
+    for job in job_store().execute("SELECT * FROM jobs WHERE status IN ('queued', 'rendering')").fetchall():
+        if worker_is_alive(job['worker_id']):
+            continue
+        dead_workers.add(job['worker_id'])
+        claimed = job_store().execute(
+            "UPDATE jobs SET worker_id = ?, status = 'queued', stage = NULL, updated_at = ?"
+            " WHERE job_id = ? AND worker_id IS ?", (WORKER_ID, time.time(), job['job_id'], job['worker_id'])).rowcount
+        if not claimed: # Another worker was faster
+            continue
+        params = json.loads(job['params'])
+        missing = [path for key, path in params.items() if key.endswith('_path') and path and not os.path.exists(path)]
+        if missing:
+            logging.warning(f"Cannot resume job {job['job_id']}, inputs are gone: {missing}")
+            update_job(job['job_id'], status='failed', message='Inputs of the interrupted job are no longer available')
+            continue
+        params = load_job_params(job)
+        output_path = job['output_path']
+        remove_path(video_output_unit(output_path)) # Partial output of the interrupted render
+        if job['output_mode'] == 'hls':
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        ticket = admission.enqueue(params['cost'], job['client_id'], preview=params['render_mode'] == 'preview', force=True)
+        threading.Thread(target=run_render_job, daemon=True,
+                         args=(job['job_id'], ticket, params, output_path,
+                               video_ffmpeg_params(job['output_mode'], output_path))).start()
+        logging.info(f"Restarted interrupted job {job['job_id']}")
+    for worker_id in dead_workers:
+        if worker_id:
+            try:
+                os.remove(os.path.join(JOB_WORKERS_FOLDER, f"{worker_id}.lock"))
+            except FileNotFoundError:
+                pass
+
+def reserve_idempotency_key(client_id, idempotency_key):
+    """
+    Reserves a client's idempotency key for a new job. Returns (None, True) when reserved, or
+    (job id, False) when the key already belongs to a job, or (None, False) while the request that
+    reserved it is still running without a job yet. Expired keys, keys whose job was pruned and keys
+    left behind by dead workers are taken over.
+    """
+    connection = job_store()
+    now = time.time()
+    connection.execute('BEGIN IMMEDIATE') # Serializes concurrent retries across threads and processes
+    try:
+        row = connection.execute("SELECT * FROM idempotency_keys WHERE client_id = ? AND idempotency_key = ?",
+                                 (client_id, idempotency_key)).fetchone()
+        if row and now - row['created_at'] < app.config['IDEMPOTENCY_KEY_TTL_SECONDS']:
+            if row['job_id'] and get_job(row['job_id']):
+                connection.execute('COMMIT')
+                return row['job_id'], False
+            if not row['job_id'] and worker_is_alive(row['worker_id']):
+                connection.execute('COMMIT')
+                return None, False
+        connection.execute("INSERT OR REPLACE INTO idempotency_keys (client_id, idempotency_key, job_id, worker_id, created_at)"
+                           " VALUES (?, ?, NULL, ?, ?)", (client_id, idempotency_key, WORKER_ID, now))
+        connection.execute('COMMIT')
+        return None, True
+    except Exception:
+        connection.execute('ROLLBACK')
         raise
 
+def bind_idempotency_key(client_id, idempotency_key, job_id):
+    job_store().execute("UPDATE idempotency_keys SET job_id = ? WHERE client_id = ? AND idempotency_key = ?",
+                        (job_id, client_id, idempotency_key))
+
+def release_idempotency_key(client_id, idempotency_key):
+    """Frees a key whose request ended without a job (rejected), so the client's retry is processed anew."""
+    job_store().execute("DELETE FROM idempotency_keys WHERE client_id = ? AND idempotency_key = ?",
+                        (client_id, idempotency_key))
+
+def job_response(job):
+    """The generate response for a job: its result once finished, else 202 with its status URL."""
+    if job['status'] == 'completed':
+        return {'message': 'Video generated successfully', 'video_url': job['video_url'], 'job_id': job['job_id']}, 200
+    if job['status'] == 'rejected':
+        return {'message': job['message'], 'job_id': job['job_id']}, 429, {'Retry-After': '1'}
+    if job['status'] == 'too_long':
+        return {'message': job['message'], 'job_id': job['job_id']}, 413
+    if job['status'] == 'failed':
+        return {'message': job['message'], 'job_id': job['job_id']}, 500
+    return {'message': 'Video generation started', 'job_id': job['job_id'], 'video_url': job['video_url'],
+            'status_url': f"/api/v2/podcast/jobs/{job['job_id']}"}, 202
+
+def attach_to_job(job_id, respond_async):
+    """
+    Answers a retried request from the job its first attempt started; synchronous retries wait for it
+    while the worker process that owns it is alive. A job whose worker died only moves on once another
+    worker boots and recovers it, so the retry then gets the 202 status response instead.
+    """
+    job = get_job(job_id)
+    respond_async = respond_async or job['output_mode'] in PROGRESSIVE_OUTPUT_MODES
+    while job['status'] in ('queued', 'rendering') and not respond_async and worker_is_alive(job['worker_id']):
+        time.sleep(IDEMPOTENCY_POLL_SECONDS) # The job may be rendered by another worker process
+        job = get_job(job_id)
+    return job_response(job)
+
+def prefers_respond_async():
+    """True if the request carries an RFC 7240 'Prefer: respond-async' header."""
+    preferences = request.headers.get('Prefer', '')
+    return any(p.split(';')[0].strip().lower() == 'respond-async' for p in preferences.split(','))
+
 class PodcastGenerate(Resource):
     def post(self):
         logging.info("Received request for podcast generation.")
+        saved_files = {}
+        upload_scratch_dir = None
+        ticket = None
+        client_id = request.headers.get(CLIENT_ID_HEADER) or request.remote_addr
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        key_reserved = False # Reserved by this request and not yet bound to a job
 
-        uploaded_audio_file = request.files.get('uploadedAudio')
-        recorded_audio_file = request.files.get('recordedAudio')
+        try:
+            # A retry is answered from the original job before its body is even read
+            if idempotency_key is not None:
+                if not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+                    return {'message': f'{IDEMPOTENCY_KEY_HEADER} must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters'}, 400
+                existing_job_id, key_reserved = reserve_idempotency_key(client_id, idempotency_key)
+                if existing_job_id:
+                    logging.info(f"Retry with {IDEMPOTENCY_KEY_HEADER} {idempotency_key!r} attached to job {existing_job_id}")
+                    return attach_to_job(existing_job_id, prefers_respond_async())
+                if not key_reserved:
+                    return ({'message': f'A request with this {IDEMPOTENCY_KEY_HEADER} is still being uploaded'}, 409,
+                            {'Retry-After': '1'})
 
-        final_audio_segment = None
-        temp_audio_filepath = None
+            # Stream all uploads to scratch, rejecting bad types and oversized files as early as possible.
+            # The request size is the uploads' budget; without a Content-Length assume the worst.
+            upload_scratch_dir = allocate_scratch_dir(request.content_length or app.config['MAX_CONTENT_LENGTH'])
+            try:
+                form, saved_files = stream_multipart_upload(UPLOAD_FILE_FIELDS, upload_scratch_dir)
+            except UploadRejected as e:
+                logging.warning(f"Upload rejected: {e}")
+                return {'message': str(e)}, e.status_code
 
-        uploaded_audio_path = None
-        recorded_audio_path = None
+            params, error = parse_generate_request(form, saved_files)
+            if error:
+                return error
 
-        try:
-            # --- Handle Uploaded Audio ---
-            if uploaded_audio_file and uploaded_audio_file.filename != '':
-                if not allowed_file(uploaded_audio_file.filename, ALLOWED_AUDIO_EXTENSIONS):
-                    logging.warning(f"Uploaded audio file extension not allowed: {uploaded_audio_file.filename}")
-                    return {'message': 'Uploaded audio file type not allowed'}, 400
-                uploaded_audio_filename = secure_filename(uploaded_audio_file.filename)
-                uploaded_audio_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}_{uploaded_audio_filename}")
-                uploaded_audio_file.save(uploaded_audio_path)
-                logging.info(f"Uploaded audio file saved to: {uploaded_audio_path}")
-                
-                final_audio_segment = AudioSegment.from_file(uploaded_audio_path)
-                # Apply background volume to the uploaded audio
-                final_audio_segment = final_audio_segment + BACKGROUND_AUDIO_VOLUME_DB 
-
-            # --- Handle Recorded Audio ---
-            if recorded_audio_file and recorded_audio_file.filename != '':
-                if not allowed_file(recorded_audio_file.filename, ALLOWED_AUDIO_EXTENSIONS):
-                    logging.warning(f"Recorded audio file extension not allowed: {recorded_audio_file.filename}")
-                    return {'message': 'Recorded audio file type not allowed'}, 400
-                recorded_audio_filename = secure_filename(recorded_audio_file.filename)
-                recorded_audio_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}_{recorded_audio_filename}")
-                recorded_audio_file.save(recorded_audio_path)
-                logging.info(f"Recorded audio file saved to: {recorded_audio_path}")
-                
-                recorded_audio_segment = AudioSegment.from_file(recorded_audio_path)
-                
-                # Apply equalization and noise reduction to the recorded voice
-                recorded_audio_segment = equalize_and_denoise_recorded_voice(recorded_audio_segment)
-
-                if final_audio_segment: # If uploaded audio exists, overlay recorded audio
-                    # Extend background audio if recorded audio is longer
-                    if len(recorded_audio_segment) > len(final_audio_segment):
-                        # Pad final_audio_segment with silence to match recorded audio length
-                        silence = AudioSegment.silent(duration=len(recorded_audio_segment) - len(final_audio_segment))
-                        final_audio_segment += silence
-                    
-                    final_audio_segment = final_audio_segment.overlay(recorded_audio_segment, position=0)
-                else: # Only recorded audio provided
-                    final_audio_segment = recorded_audio_segment
-            
-            if final_audio_segment is None:
-                logging.warning("No audio files provided for video generation.")
-                return {'message': 'No audio files provided'}, 400
-
-            # Export the merged/single audio segment to a temporary file for MoviePy
-            temp_audio_filename = f"merged_audio_{uuid.uuid4()}.mp3" # Using MP3 for broader compatibility
-            temp_audio_filepath = os.path.join(app.config['UPLOAD_FOLDER'], temp_audio_filename)
-            final_audio_segment.export(temp_audio_filepath, format="mp3")
-            logging.info(f"Final audio segment exported to: {temp_audio_filepath}")
-
-            # Extract and validate other parameters
-            waveform_style = request.form.get('waveformStyle')
-            waveform_color = request.form.get('waveformColor')
-            background_color_hex = request.form.get('backgroundColor')
-            background_opacity_str = request.form.get('backgroundOpacity')
-            playback_speed_str = request.form.get('playbackSpeed')
-            text_overlay = request.form.get('textOverlay', '')
-            audio_output_format = request.form.get('downloadFormat', 'mp3').lower() 
-
-            # Basic validation for other fields
-            if waveform_style not in ['bars', 'lines', 'circles', 'frequency-bars', 'smooth-lines']:
-                logging.warning(f"Invalid waveform style: {waveform_style}")
-                return {'message': 'Invalid waveform style'}, 400
-            if not validate_color(waveform_color):
-                logging.warning(f"Invalid waveform color: {waveform_color}")
-                return {'message': 'Invalid waveform color format'}, 400
-            if not validate_color(background_color_hex):
-                logging.warning(f"Invalid background color: {background_color_hex}")
-                return {'message': 'Invalid background color format'}, 400
-            if not validate_float_range(background_opacity_str, 0.0, 1.0):
-                logging.warning(f"Invalid background opacity: {background_opacity_str}")
-                return {'message': 'Invalid background opacity value (must be between 0 and 1)'}, 400
-            if not validate_float_range(playback_speed_str, 0.1, 5.0): # Assuming reasonable speed range
-                logging.warning(f"Invalid playback speed: {playback_speed_str}")
-                return {'message': 'Invalid playback speed value'}, 400
-            if audio_output_format not in ['webm', 'wav', 'mp3', 'aac']: # Added aac as a common video audio codec
-                logging.warning(f"Invalid audio output format for video: {audio_output_format}")
-                return {'message': 'Invalid audio output format for video'}, 400
-
-            background_opacity = float(background_opacity_str)
-            playback_speed = float(playback_speed_str)
-
-            # Handle background image
-            background_image_file = request.files.get('backgroundImage')
-            background_image_filepath = None
-            if background_image_file and background_image_file.filename != '':
-                if not allowed_file(background_image_file.filename, ALLOWED_IMAGE_EXTENSIONS):
-                    logging.warning(f"Background image extension not allowed: {background_image_file.filename}")
-                    return {'message': 'Background image file type not allowed'}, 400
-                bg_image_filename = secure_filename(background_image_file.filename)
-                unique_bg_image_filename = f"{uuid.uuid4()}_{bg_image_filename}"
-                background_image_filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_bg_image_filename)
-                background_image_file.save(background_image_filepath)
-                logging.info(f"Background image saved to: {background_image_filepath}")
-
-            output_video_filename = f"waveform_video_{uuid.uuid4()}.mp4" # Always output MP4 video
-            output_video_filepath = os.path.join(app.config['GENERATED_FILES_FOLDER'], output_video_filename)
-
-            temp_frames_dir = os.path.join(app.config['TEMP_FRAMES_FOLDER'], str(uuid.uuid4()))
-            os.makedirs(temp_frames_dir, exist_ok=True)
-
-            # 1. Load the merged audio clip using MoviePy
-            audio_clip = AudioFileClip(temp_audio_filepath)
-            
-            # Apply playback speed to audio clip (already applied to pydub segment, but good to keep consistency)
-            # MoviePy's speedx might re-encode, so it's better to do it once with pydub
-            # audio_clip = audio_clip.speedx(playback_speed) # Removed as speed is handled by pydub now
-
-            # Define video dimensions and FPS
-            video_width, video_height = 1280, 720 
-            video_fps = 24 # Standard video FPS
-
-            # 2. Generate waveform frames from the *merged* audio
-            waveform_frame_paths = generate_waveform_frames(
-                temp_audio_filepath, audio_clip.duration, video_fps, 
-                video_width, video_height, waveform_style, waveform_color, temp_frames_dir
-            )
-            waveform_clip = ImageSequenceClip(waveform_frame_paths, fps=video_fps)
-
-            # 3. Create the background video clip
-            if background_image_filepath:
-                background_clip = ImageClip(background_image_filepath).with_duration(audio_clip.duration)
-                background_clip = background_clip.resized((video_width, video_height)) 
-            else:
-                rgb_color = hex_to_rgb(background_color_hex)
-                background_clip = ColorClip(size=(video_width, video_height), 
-                                            color=rgb_color, 
-                                            duration=audio_clip.duration)
-                # For opacity, MoviePy handles it when compositing if the top layer has alpha.
-                # If background_clip itself needs opacity, it would be done via compositing with another video.
-                # For a solid color background, opacity is less relevant unless compositing with another video.
-
-            # 4. Create the text overlay clip
-            all_clips = [background_clip, waveform_clip]
-            if text_overlay:
-                text_clip = TextClip(text_overlay, 
-                                     fontsize=50, 
-                                     color='white', 
-                                     # Removed 'font' argument to avoid TypeError
-                                     stroke_color='black',
-                                     stroke_width=1
-                                     # Removed bg_color='transparent' as it causes error
-                                     )
-                # Updated syntax for moviepy 2.2.1
-                text_clip = text_clip.with_position(('center', 0.05)).with_duration(audio_clip.duration)
-                all_clips.append(text_clip)
-                
-            # Composite all clips
-            final_video_clip = CompositeVideoClip(all_clips, size=(video_width, video_height))
-
-            # 5. Set the audio of the final video clip
-            final_video_clip = final_video_clip.with_audio(audio_clip)
-
-            # 6. Write the final video file
-            # Use 'libx264' for video codec and 'aac' for audio codec for MP4
-            final_video_clip.write_videofile(output_video_filepath, 
-                                            fps=video_fps, 
-                                            codec='libx264', 
-                                            audio_codec='aac',
-                                            threads=4) # Use multiple threads for faster encoding
-            logging.info(f"Video generated successfully: {output_video_filepath}")
-            
-            # Construct the URL for download
-            video_url = f"/api/v2/podcast/download/{os.path.basename(output_video_filepath)}"
-            logging.info(f"Generated video download URL: {video_url}")
+            hash_job_inputs(params, saved_files)
+            content_hash = job_content_hash(params)
+            previous_job = find_completed_job(content_hash)
+            if previous_job:
+                logging.info(f"Identical request, reusing the result of job {previous_job['job_id']}")
+                if key_reserved:
+                    bind_idempotency_key(client_id, idempotency_key, previous_job['job_id'])
+                    key_reserved = False
+                return {'message': 'Video generated successfully', 'video_url': previous_job['video_url'],
+                        'job_id': previous_job['job_id']}, 200
+
+            # Back pressure: a full queue is rejected before anything is planned or decoded
+            try:
+                ticket = admission.enqueue(params['cost'], client_id, preview=params['render_mode'] == 'preview')
+            except AdmissionRejected as e:
+                logging.warning(f"Render not admitted ({admission.snapshot()}): {e}")
+                return {'message': str(e)}, 429, {'Retry-After': str(e.retry_after)}
+
+            # The inputs are stored durably before the job exists, so a restart can always resume it
+            persist_job_inputs(params, saved_files)
+            output_video_filepath, video_url = plan_video_output(params['output_mode'])
+            ffmpeg_params = video_ffmpeg_params(params['output_mode'], output_video_filepath)
+            job_id = uuid.uuid4().hex
+            create_job(job_id, content_hash, params, output_video_filepath, video_url, client_id)
+            if key_reserved:
+                bind_idempotency_key(client_id, idempotency_key, job_id)
+                key_reserved = False
+
+            respond_async = prefers_respond_async()
+            if respond_async or params['output_mode'] in PROGRESSIVE_OUTPUT_MODES:
+                # Answer right away; progressive outputs can be played while they are still encoding
+                threading.Thread(target=run_render_job, daemon=True,
+                                 args=(job_id, ticket, params, output_video_filepath, ffmpeg_params)).start()
+                ticket = None # The render thread owns it now
+                logging.info(f"Started render job {job_id}, video URL: {video_url}")
+                return ({'message': 'Video generation started', 'job_id': job_id, 'video_url': video_url,
+                         'status_url': f"/api/v2/podcast/jobs/{job_id}"}, 202,
+                        {'Preference-Applied': 'respond-async'} if respond_async else {})
 
-            # Updated return statement as per user's request
-            return {'message': 'Video generated successfully', 'video_url': video_url}, 200
+            try:
+                admission.wait(ticket, ADMISSION_MAX_QUEUE_WAIT_SECONDS)
+            except AdmissionRejected as e:
+                ticket = None
+                update_job(job_id, status='rejected', message=str(e))
+                if idempotency_key is not None:
+                    release_idempotency_key(client_id, idempotency_key)
+                logging.warning(f"Render not admitted ({admission.snapshot()}): {e}")
+                return {'message': str(e)}, 429, {'Retry-After': str(e.retry_after)}
+
+            job = run_render_job(job_id, ticket, params, output_video_filepath, ffmpeg_params)
+            ticket = None
+            logging.info(f"Generated video download URL: {video_url}")
+            return job_response(job)
 
         except Exception as e:
             logging.error(f"Error during video generation: {e}", exc_info=True)
-            # Check for FFmpeg specific errors
-            if "ffmpeg" in str(e).lower() and "not found" in str(e).lower():
-                error_message = "FFmpeg is not installed or not accessible in your system's PATH. Please install FFmpeg."
-            else:
-                error_message = f'Video generation failed: {str(e)}.'
-            return {'message': error_message}, 500
+            return {'message': describe_render_error(e)}, 500
         finally:
-            # Clean up uploaded files and temporary frames
-            if uploaded_audio_path and os.path.exists(uploaded_audio_path):
-                os.remove(uploaded_audio_path)
-                logging.info(f"Cleaned up uploaded audio: {uploaded_audio_path}")
-            if recorded_audio_path and os.path.exists(recorded_audio_path):
-                os.remove(recorded_audio_path)
-                logging.info(f"Cleaned up recorded audio: {recorded_audio_path}")
-            if temp_audio_filepath and os.path.exists(temp_audio_filepath):
-                os.remove(temp_audio_filepath)
-                logging.info(f"Cleaned up temporary merged audio: {temp_audio_filepath}")
-            if os.path.exists(temp_frames_dir):
-                shutil.rmtree(temp_frames_dir)
-                logging.info(f"Cleaned up temporary frames directory: {temp_frames_dir}")
+            # Clean up uploaded files (temporary audio and frames are cleaned up by the render itself)
+            if ticket:
+                admission.release(ticket)
+            if key_reserved:
+                release_idempotency_key(client_id, idempotency_key)
+            cleanup_saved_files(saved_files)
+            release_scratch_dir(upload_scratch_dir)
+
+class PodcastJob(Resource):
+    def get(self, job_id):
+        job = get_job(job_id)
+        if job is None:
+            return {'message': 'Job not found'}, 404
+        return job_status(job), 200
+
+class PodcastResult(Resource):
+    def get(self, content_hash):
+        """Looks up a finished video by the content hash of its inputs and options."""
+        job = find_completed_job(content_hash)
+        if job is None:
+            return {'message': 'Result not found'}, 404
+        return job_status(job), 200
+
+class SchedulerStats(Resource):
+    def get(self):
+        """Reports the scheduling policy, queue state and per-policy queue-wait/turnaround percentiles."""
+        return admission.stats(), 200
 
 class DownloadFile(Resource):
     def get(self, filename):
         logging.info(f"Received download request for: {filename}")
         try:
-            return send_from_directory(app.config['GENERATED_FILES_FOLDER'], filename, as_attachment=True)
+            return serve_generated_file(filename)
         except FileNotFoundError:
             logging.warning(f"File not found for download: {filename}")
             return {'message': 'File not found'}, 404
@@ -416,10 +2886,373 @@ class DownloadFile(Resource):
             logging.error(f"Error serving file {filename} for download: {e}", exc_info=True)
             return {'message': f'Error serving file: {str(e)}'}, 500
 
+class UploadSessions(Resource):
+    def post(self):
+        """Creates a resumable upload and preallocates its file so chunks can be written in any order."""
+        data = request.get_json(silent=True) or {}
+        filename = secure_filename(str(data.get('filename', '')))
+        try:
+            size = int(data.get('size'))
+            chunk_size = int(data.get('chunkSize', DEFAULT_RESUMABLE_CHUNK_BYTES))
+        except (ValueError, TypeError):
+            return {'message': 'size and chunkSize must be integers'}, 400
+
+        if not allowed_file(filename, ALLOWED_AUDIO_EXTENSIONS):
+            logging.warning(f"Resumable upload extension not allowed: {filename}")
+            return {'message': 'Audio file type not allowed'}, 400
+        if not 0 < size <= MAX_RESUMABLE_UPLOAD_BYTES:
+            return {'message': f'size must be between 1 and {MAX_RESUMABLE_UPLOAD_BYTES} bytes'}, 413
+        if not 0 < chunk_size <= MAX_RESUMABLE_CHUNK_BYTES:
+            return {'message': f'chunkSize must be between 1 and {MAX_RESUMABLE_CHUNK_BYTES} bytes'}, 400
+
+        upload_id = uuid.uuid4().hex
+        part_path, _ = upload_session_paths(upload_id)
+        with open(part_path, 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size) # Reserve the blocks up front (fails fast on a full disk)
+            except (AttributeError, OSError):
+                f.truncate(size) # Sparse fallback where fallocate is unsupported
+
+        session = {
+            'upload_id': upload_id,
+            'filename': filename,
+            'kind': 'audio',
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': (size + chunk_size - 1) // chunk_size,
+            'received': [],
+            'state': 'uploading',
+            'created_at': time.time(),
+        }
+        with upload_sessions_lock:
+            save_upload_session(session)
+        logging.info(f"Created resumable upload {upload_id} for {filename} ({size} bytes, {session['total_chunks']} chunks)")
+        return upload_session_status(session), 201
+
+class UploadSession(Resource):
+    def get(self, upload_id):
+        """Reports which chunks have arrived so a client can resume after a dropped connection."""
+        session = load_upload_session(upload_id)
+        if session is None:
+            return {'message': 'Upload not found'}, 404
+        return upload_session_status(session), 200
+
+class UploadChunk(Resource):
+    def put(self, upload_id, index):
+        """Writes one chunk straight into its slot of the preallocated file with os.pwrite."""
+        session = load_upload_session(upload_id)
+        if session is None:
+            return {'message': 'Upload not found'}, 404
+        if session['state'] != 'uploading':
+            return {'message': f"Upload is {session['state']}"}, 409
+        if not 0 <= index < session['total_chunks']:
+            return {'message': 'Chunk index out of range'}, 400
+
+        offset = index * session['chunk_size']
+        expected_bytes = min(session['chunk_size'], session['size'] - offset)
+        part_path, _ = upload_session_paths(upload_id)
+
+        written = 0
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            while True:
+                data = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                if written + len(data) > expected_bytes:
+                    return {'message': f'Chunk {index} is larger than {expected_bytes} bytes'}, 400
+                if index == 0 and written == 0 and sniff_media_kind(data) != session['kind']:
+                    return {'message': 'Audio file content does not match its type'}, 400
+                view = memoryview(data)
+                while view: # pwrite may write less than requested
+                    n = os.pwrite(fd, view, offset + written)
+                    written += n
+                    view = view[n:]
+        finally:
+            os.close(fd)
+
+        if written != expected_bytes:
+            return {'message': f'Chunk {index} incomplete: received {written} of {expected_bytes} bytes'}, 400
+
+        with upload_sessions_lock:
+            session = load_upload_session(upload_id)
+            if index not in session['received']:
+                session['received'].append(index)
+                save_upload_session(session)
+        return {'upload_id': upload_id, 'index': index, 'received': len(session['received']),
+                'total_chunks': session['total_chunks']}, 200
+
+class UploadSessionComplete(Resource):
+    def post(self, upload_id):
+        """Finalizes a fully received upload into the asset library and returns its asset id."""
+        with upload_sessions_lock:
+            session = load_upload_session(upload_id)
+            if session is None:
+                return {'message': 'Upload not found'}, 404
+            status = upload_session_status(session)
+            if status['missing_chunks']:
+                return dict(status, message='Upload has missing chunks'), 409
+            if session['state'] != 'uploading':
+                return {'message': f"Upload is {session['state']}"}, 409
+            session['state'] = 'finalizing' # Rejects further chunk writes while the file is hashed
+            save_upload_session(session)
+
+        part_path, manifest_path = upload_session_paths(upload_id)
+        # Only the first chunk's magic bytes were checked, so the assembled file must really be readable audio
+        try:
+            probe = probe_audio(part_path)
+            probe_error = audio_probe_error(probe)
+        except ValueError:
+            probe_error = ('Uploaded file is not readable audio', 400)
+        if probe_error:
+            logging.warning(f"Rejected resumable upload {upload_id}: {probe_error[0]}")
+            remove_path(part_path)
+            remove_path(manifest_path)
+            return {'message': probe_error[0]}, probe_error[1]
+
+        try:
+            with open(part_path, 'rb+') as f:
+                os.fsync(f.fileno())
+            asset_id = add_asset_from_file(part_path, session['filename'], session['kind'], **audio_asset_meta(probe))
+        except Exception as e:
+            logging.error(f"Error finalizing upload {upload_id}: {e}", exc_info=True)
+            with upload_sessions_lock:
+                session['state'] = 'uploading'
+                save_upload_session(session)
+            return {'message': f'Finalizing upload failed: {str(e)}'}, 500
+
+        os.remove(manifest_path)
+        logging.info(f"Finalized resumable upload {upload_id} as asset {asset_id}")
+        return {'asset_id': asset_id, 'filename': session['filename'], 'size': session['size']}, 200
+
+class Recordings(Resource):
+    def post(self):
+        """Starts a live recording that accepts MediaRecorder chunks while the user is still recording."""
+        session = start_recording_session()
+        return {'recording_id': session['recording_id'], 'state': session['state']}, 201
+
+class RecordingChunk(Resource):
+    def put(self, recording_id, index):
+        """Decodes and filters one recorder chunk as soon as all earlier chunks have arrived."""
+        with recording_sessions_lock:
+            session = recording_sessions.get(recording_id)
+        if session is None:
+            return {'message': 'Recording not found'}, 404
+
+        chunks = []
+        received = 0
+        while True:
+            data = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+            if received > MAX_RECORDING_CHUNK_BYTES:
+                return {'message': f'Chunk {index} is larger than {MAX_RECORDING_CHUNK_BYTES} bytes'}, 413
+            chunks.append(data)
+        if not chunks:
+            return {'message': f'Chunk {index} is empty'}, 400
+
+        with session['lock']:
+            if session['state'] != 'recording':
+                return {'message': f"Recording is {session['state']}"}, 409
+            session['last_activity'] = time.time()
+            error = feed_recording_chunk(session, index, b''.join(chunks))
+            failed = session['state'] == 'failed'
+        if failed:
+            discard_recording_session(session)
+            return {'message': error}, 422
+        if error:
+            return {'message': error}, 400
+        return {'recording_id': recording_id, 'index': index, 'next_index': session['next_index']}, 200
+
+class RecordingFinish(Resource):
+    def post(self, recording_id):
+        """Flushes a live recording and stores its processed voice track as an asset ready for rendering."""
+        with recording_sessions_lock:
+            session = recording_sessions.get(recording_id)
+        if session is None:
+            return {'message': 'Recording not found'}, 404
+        expected_chunks = (request.get_json(silent=True) or {}).get('chunks')
+        with session['lock']:
+            if session['state'] != 'recording':
+                return {'message': f"Recording is {session['state']}"}, 409
+            if session['pending'] or (expected_chunks is not None and session['next_index'] != expected_chunks):
+                return {'message': 'Recording has missing chunks', 'next_index': session['next_index']}, 409
+            if session['next_index'] == 0:
+                return {'message': 'Recording is empty'}, 400
+            session['state'] = 'finishing'
+
+        try:
+            session['process'].stdin.close()
+            session['process'].wait(timeout=RECORDING_FINISH_TIMEOUT_SECONDS)
+            if session['process'].returncode != 0:
+                logging.warning(f"Live recording {recording_id} failed: {recording_ffmpeg_error(session)}")
+                return {'message': f"Recording could not be decoded: {recording_ffmpeg_error(session)}"}, 422
+            asset_id = add_asset_from_file(session['output_path'], 'recording.wav', 'audio', voice_processed=True,
+                                           **audio_asset_meta(probe_audio(session['output_path'])))
+            pcm = load_asset_pcm(asset_id) # Fill the PCM cache now so the render starts without decoding
+        except AudioTooLong as e:
+            logging.warning(f"Live recording {recording_id} rejected: {e}")
+            return {'message': str(e)}, 413
+        except Exception as e:
+            logging.error(f"Error finishing live recording {recording_id}: {e}", exc_info=True)
+            return {'message': f'Finishing recording failed: {str(e)}'}, 500
+        finally:
+            discard_recording_session(session)
+        logging.info(f"Finished live recording {recording_id} as asset {asset_id}")
+        return {'asset_id': asset_id, 'duration_seconds': len(pcm) / ASSET_PCM_SAMPLE_RATE, 'voice_processed': True}, 200
+
+class Assets(Resource):
+    def post(self):
+        """Adds an 'audio' or 'image' file to the asset library so later jobs can reference it by id."""
+        try:
+            _, saved_files = stream_multipart_upload(ASSET_FILE_FIELDS, app.config['UPLOAD_FOLDER'])
+        except UploadRejected as e:
+            logging.warning(f"Asset upload rejected: {e}")
+            return {'message': str(e)}, e.status_code
+        if len(saved_files) != 1:
+            cleanup_saved_files(saved_files)
+            return {'message': "Send exactly one 'audio' or 'image' file"}, 400
+
+        kind, saved_path = next(iter(saved_files.items()))
+        original_filename = os.path.basename(saved_path).split('_', 1)[1] # Strip the uuid prefix
+        extra_meta = {}
+        if kind == 'audio':
+            try:
+                extra_meta = audio_asset_meta(probe_audio(saved_path))
+            except ValueError:
+                cleanup_saved_files(saved_files)
+                return {'message': 'Audio asset is not readable audio'}, 400
+        try:
+            asset_id = add_asset_from_file(saved_path, original_filename, kind, **extra_meta)
+        except Exception as e:
+            logging.error(f"Error storing asset: {e}", exc_info=True)
+            if os.path.exists(saved_path):
+                os.remove(saved_path)
+            return {'message': f'Storing asset failed: {str(e)}'}, 500
+        finally:
+            release_paths(saved_path)
+        return dict(load_asset_meta(asset_id), asset_id=asset_id), 201
+
+class Asset(Resource):
+    def get(self, asset_id):
+        meta = load_asset_meta(asset_id)
+        if meta is None:
+            return {'message': 'Asset not found'}, 404
+        return dict(meta, asset_id=asset_id), 200
+
+class AssetPeaks(Resource):
+    def get(self, asset_id):
+        """
+        Without samplesPerPixel, lists the levels of an audio asset's peaks pyramid; with it, returns
+        that level as an audiowaveform .dat file (bits=8 or 16). Assets never change, so neither do their peaks.
+        """
+        meta = load_asset_meta(asset_id)
+        if meta is None or meta.get('kind') != 'audio':
+            return {'message': 'Audio asset not found'}, 404
+        samples_per_pixel = request.args.get('samplesPerPixel', type=int)
+        bits = request.args.get('bits', 16, type=int)
+        if samples_per_pixel is None:
+            # Exact once the pyramid is built; until then estimated from the duration probed at ingest, without a decode
+            base_path = os.path.join(app.config['ASSET_LIBRARY_FOLDER'], asset_id, f"peaks_{PEAKS_BASE_SAMPLES_PER_PIXEL}.npy")
+            if os.path.exists(base_path):
+                base_length = len(np.load(base_path, mmap_mode='r'))
+            else:
+                duration = meta.get('duration_seconds')
+                if duration is None: # Stored before durations were recorded
+                    duration = probe_audio(get_asset_path(asset_id, 'audio'))['duration']
+                base_length = -(-round(duration * ASSET_PCM_SAMPLE_RATE) // PEAKS_BASE_SAMPLES_PER_PIXEL)
+            return {'asset_id': asset_id, 'sample_rate': ASSET_PCM_SAMPLE_RATE, 'bits': list(PEAKS_BITS),
+                    'levels': [{'samples_per_pixel': level,
+                                'length': -(-base_length // (level // PEAKS_BASE_SAMPLES_PER_PIXEL)),
+                                'url': f"/api/v2/assets/{asset_id}/peaks?samplesPerPixel={level}"}
+                               for level in peaks_levels()]}, 200
+        if samples_per_pixel not in peaks_levels():
+            return {'message': f"samplesPerPixel must be one of {', '.join(map(str, peaks_levels()))}"}, 400
+        if bits not in PEAKS_BITS:
+            return {'message': 'bits must be 8 or 16'}, 400
+
+        etag = f"{asset_id}-{samples_per_pixel}-{bits}"
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=31536000, immutable'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        try:
+            peaks = load_asset_peaks(asset_id, samples_per_pixel)
+        except AudioTooLong as e:
+            return {'message': str(e)}, 413
+        body = encode_peaks_dat(peaks, samples_per_pixel, bits)
+        return Response(body, headers=headers, content_type='application/octet-stream')
+
+admission = AdmissionController(app.config['ADMISSION_CPU_THREADS'], app.config['ADMISSION_RAM_BYTES'],
+                                app.config['ADMISSION_MAX_QUEUED'])
+
 api.add_resource(PodcastGenerate, '/api/v2/podcast/generate')
-api.add_resource(DownloadFile, '/api/v2/podcast/download/<string:filename>')
+api.add_resource(DownloadFile, '/api/v2/podcast/download/<path:filename>') # HLS outputs live in a subdirectory
+api.add_resource(PodcastJob, '/api/v2/podcast/jobs/<string:job_id>')
+api.add_resource(PodcastResult, '/api/v2/podcast/results/<string:content_hash>')
+api.add_resource(SchedulerStats, '/api/v2/podcast/scheduler')
+api.add_resource(UploadSessions, '/api/v2/uploads')
+api.add_resource(UploadSession, '/api/v2/uploads/<string:upload_id>')
+api.add_resource(UploadChunk, '/api/v2/uploads/<string:upload_id>/chunks/<int:index>')
+api.add_resource(UploadSessionComplete, '/api/v2/uploads/<string:upload_id>/complete')
+api.add_resource(Recordings, '/api/v2/recordings')
+api.add_resource(RecordingChunk, '/api/v2/recordings/<string:recording_id>/chunks/<int:index>')
+api.add_resource(RecordingFinish, '/api/v2/recordings/<string:recording_id>/finish')
+api.add_resource(Assets, '/api/v2/assets')
+api.add_resource(Asset, '/api/v2/assets/<string:asset_id>')
+api.add_resource(AssetPeaks, '/api/v2/assets/<string:asset_id>/peaks')
+
+def start_worker():
+    """
+    Readies this process to serve requests: creates the job store, takes the worker lock, restarts the
+    interrupted jobs of dead workers and starts the janitor. Runs once per process, and only in processes
+    that serve requests, so a plain import (tests, the flask CLI, a shell) or the Werkzeug reloader's
+    watcher process never resumes renders. The worker id is drawn here rather than at import so that
+    workers forked from a preloaded app (gunicorn --preload) each get their own id and lock.
+    """
+    global WORKER_ID, worker_pid
+    with worker_start_lock:
+        if worker_pid == os.getpid():
+            return
+        WORKER_ID = uuid.uuid4().hex
+        init_job_store()
+        hold_worker_lock()
+        if app.config['JOB_RESUME_ON_BOOT']:
+            recover_interrupted_jobs()
+        if app.config['JANITOR_ENABLED']:
+            start_janitor()
+        worker_pid = os.getpid()
+
+def reset_worker_after_fork():
+    """A forked child is a new worker: it drops the parent's lock fd and SQLite connection and starts afresh."""
+    global worker_lock_fd, worker_pid, job_store_local
+    if worker_lock_fd is not None:
+        os.close(worker_lock_fd) # The parent still holds the lock through its own descriptor
+    worker_lock_fd = None
+    worker_pid = None
+    job_store_local = threading.local()
+
+os.register_at_fork(after_in_child=reset_worker_after_fork)
+
+def create_app():
+    """
+    WSGI entry point that starts the worker right away, e.g. gunicorn 'app:create_app()'. With --preload
+    the factory runs in the gunicorn master, so load `app:app` instead and let each worker start with its
+    first request.
+    """
+    start_worker()
+    return app
+
+@app.before_request
+def ensure_worker_started():
+    """Servers that load `app` directly (flask run, gunicorn app:app) start the worker with their first request."""
+    if worker_pid != os.getpid():
+        start_worker()
 
 if __name__ == '__main__':
+    # The reloader runs this module twice: in a watcher process and in the child that serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_worker()
     # For local development, run with debug=True
     # In production, use a production-ready WSGI server like Gunicorn or uWSGI
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -88,6 +88,13 @@ let mediaRecorder;
 let audioChunks = [];
 let mediaStream; // To store the microphone stream
 
+// Live ingest: recorder chunks are uploaded while recording, so the server has the voice track
+// decoded and processed by the time recording stops
+const RECORDINGS_API_URL = 'https://192.168.1.252:5000/api/v2/recordings';
+const RECORDING_TIMESLICE_MS = 1000; // MediaRecorder emits a chunk every second
+let liveIngest = null; // { recordingId, nextIndex, queue, failed } of the recording in progress
+let recordedAudioAssetId = null; // Asset id of the processed recording, once the server has finished it
+
 
 // State variables
 let audioFile = null; // This will hold the File object for the video generation (either uploaded or recorded)
@@ -253,11 +260,52 @@ const drawWaveformVisuals = (ctx, width, height, analyserNode, style, color, tex
             ctx.lineTo(width, height / 2);
             ctx.stroke();
             break;
+        case 'bars-history':
+            drawBarsHistory(ctx, width, height, dataArray);
+            break;
+        case 'spectrogram':
+            drawSpectrogramColumn(width, height, dataArray);
+            ctx.drawImage(spectrogramHistory, 0, 0);
+            break;
         default:
             break;
     }
 };
 
+// Scrolling bars preview: the newest level enters on the right and older ones move left
+const BARS_HISTORY_PREVIEW_BARS = 100;
+const barsHistoryLevels = new Array(BARS_HISTORY_PREVIEW_BARS).fill(0);
+
+const drawBarsHistory = (ctx, width, height, dataArray) => {
+    barsHistoryLevels.shift();
+    barsHistoryLevels.push(Math.max(...dataArray) / 255);
+    const slotWidth = width / BARS_HISTORY_PREVIEW_BARS;
+    barsHistoryLevels.forEach((level, i) => {
+        const barHeight = level * height;
+        ctx.fillRect(i * slotWidth, (height - barHeight) / 2, slotWidth * 0.8, barHeight);
+    });
+};
+
+// Scrolling spectrogram preview: the history shifts left and the newest spectrum is drawn as its last column
+const SPECTROGRAM_PREVIEW_COLUMN_WIDTH = 2;
+const spectrogramHistory = document.createElement('canvas');
+
+const drawSpectrogramColumn = (width, height, dataArray) => {
+    if (spectrogramHistory.width !== width || spectrogramHistory.height !== height) {
+        spectrogramHistory.width = width;
+        spectrogramHistory.height = height;
+    }
+    const historyCtx = spectrogramHistory.getContext('2d');
+    historyCtx.drawImage(spectrogramHistory, -SPECTROGRAM_PREVIEW_COLUMN_WIDTH, 0);
+    const rowHeight = height / dataArray.length;
+    for (let i = 0; i < dataArray.length; i++) {
+        const level = dataArray[i] / 255;
+        historyCtx.fillStyle = `hsl(${280 - level * 240}, 80%, ${level * 60}%)`;
+        historyCtx.fillRect(width - SPECTROGRAM_PREVIEW_COLUMN_WIDTH, height - (i + 1) * rowHeight,
+                            SPECTROGRAM_PREVIEW_COLUMN_WIDTH, Math.ceil(rowHeight));
+    }
+};
+
 // Function to attach timeupdate and loadedmetadata listeners to the active audio element
 const attachAudioListeners = () => {
     // Remove any existing listeners from previous active elements to prevent duplicates
@@ -596,13 +644,17 @@ recordButton.addEventListener('click', async () => {
         mediaStream = await navigator.mediaDevices.getUserMedia({ audio: true });
         mediaRecorder = new MediaRecorder(mediaStream);
         audioChunks = [];
+        recordedAudioAssetId = null;
+        liveIngest = startLiveIngest();
 
         mediaRecorder.ondataavailable = (event) => {
             audioChunks.push(event.data);
+            sendLiveIngestChunk(liveIngest, event.data);
         };
 
         mediaRecorder.onstop = () => {
             const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
+            finishLiveIngest(liveIngest);
 
             loadRecordedAudio(audioBlob); // Load and activate recorded audio
 
@@ -614,7 +666,7 @@ recordButton.addEventListener('click', async () => {
             }
         };
 
-        mediaRecorder.start();
+        mediaRecorder.start(RECORDING_TIMESLICE_MS);
         recordingStatusSpan.textContent = 'Recording...';
         recordButton.style.display = 'none';
         stopRecordButton.style.display = 'inline-flex';
@@ -645,6 +697,62 @@ recordButton.addEventListener('click', async () => {
     }
 });
 
+// Live ingest helpers. Chunks are sent one after another on a promise chain so the server receives
+// them in order; if anything fails the recording falls back to uploading the full blob on generate.
+const startLiveIngest = () => {
+    const ingest = { recordingId: null, nextIndex: 0, queue: null, failed: false };
+    ingest.queue = fetch(RECORDINGS_API_URL, { method: 'POST' })
+        .then(response => {
+            if (!response.ok) throw new Error(`Server error: ${response.status}`);
+            return response.json();
+        })
+        .then(result => { ingest.recordingId = result.recording_id; })
+        .catch(error => {
+            console.warn('Live recording ingest unavailable, the recording will be uploaded on generate:', error);
+            ingest.failed = true;
+        });
+    return ingest;
+};
+
+const sendLiveIngestChunk = (ingest, chunk) => {
+    if (!ingest || chunk.size === 0) return;
+    const index = ingest.nextIndex++;
+    ingest.queue = ingest.queue.then(async () => {
+        if (ingest.failed) return;
+        const response = await fetch(`${RECORDINGS_API_URL}/${ingest.recordingId}/chunks/${index}`, {
+            method: 'PUT',
+            body: chunk,
+        });
+        if (!response.ok) {
+            console.warn(`Live ingest of chunk ${index} failed with status ${response.status}`);
+            ingest.failed = true;
+        }
+    }).catch(error => {
+        console.warn('Live ingest chunk upload failed:', error);
+        ingest.failed = true;
+    });
+};
+
+const finishLiveIngest = (ingest) => {
+    if (!ingest) return;
+    ingest.queue = ingest.queue.then(async () => {
+        if (ingest.failed) return;
+        const response = await fetch(`${RECORDINGS_API_URL}/${ingest.recordingId}/finish`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ chunks: ingest.nextIndex }),
+        });
+        if (!response.ok) {
+            console.warn(`Finishing the live recording failed with status ${response.status}`);
+            return;
+        }
+        const result = await response.json();
+        if (ingest === liveIngest) {
+            recordedAudioAssetId = result.asset_id; // Ready to render, no upload or voice processing needed
+        }
+    }).catch(error => console.warn('Finishing the live recording failed:', error));
+};
+
 stopRecordButton.addEventListener('click', () => {
     if (mediaRecorder && mediaRecorder.state !== 'inactive') {
         mediaRecorder.stop();
@@ -762,7 +870,15 @@ generateVideoButton.addEventListener('click', async () => {
     messageElement.textContent = ''; // Clear general message
 
     const formData = new FormData();
-    formData.append('audio', audioFile); // 'audio' is the field name for the audio file
+    if (audioFile === recordedAudioFileBlob && liveIngest) {
+        await liveIngest.queue; // Let a just-stopped recording finish its live ingest first
+    }
+    if (audioFile === recordedAudioFileBlob && recordedAudioAssetId) {
+        // Already uploaded and processed on the server while recording
+        formData.append('recordedAudioAssetId', recordedAudioAssetId);
+    } else {
+        formData.append('audio', audioFile); // 'audio' is the field name for the audio file
+    }
 
     // Append other parameters
     formData.append('waveformStyle', waveformStyle);
@@ -0,0 +1,30 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # The app creates its working folders in the current directory when imported
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        sys.path.remove(REPO_ROOT)
+        os.chdir(cwd)
+
+
+def test_hex_to_rgb_full_form(app_module):
+    assert app_module.hex_to_rgb('#1a2B3c') == (0x1a, 0x2b, 0x3c)
+
+
+@pytest.mark.parametrize('color, rgb', [('#fff', (255, 255, 255)), ('#000', (0, 0, 0)), ('#f80', (255, 136, 0))])
+def test_hex_to_rgb_shorthand(app_module, color, rgb):
+    assert app_module.validate_color(color)
+    assert app_module.hex_to_rgb(color) == rgb